@@ -0,0 +1,24 @@
+-- Supabase(Postgres)側でブランチの履歴を1回で取得するための関数。
+-- src/database/message_tree.py の HISTORY_SQL と同じく parent_id をたどる。起点は branches.head_id。
+-- SupabaseHandler.load_history から rpc("load_history", {"p_branch_id": ...}) で呼ばれる。
+create or replace function load_history(p_branch_id bigint)
+returns table (node_id bigint, role text, content text)
+language sql stable
+as $$
+    with recursive chain(id, parent_id, role, message_id, depth) as (
+        select n.id, n.parent_id, n.role, n.message_id, n.depth
+        from message_nodes n
+        where n.id = (select b.head_id from branches b where b.id = p_branch_id)
+        union all
+        select n.id, n.parent_id, n.role, n.message_id, n.depth
+        from message_nodes n join chain c on n.id = c.parent_id
+    )
+    select c.id, c.role, coalesce(s.content, u.content, l.content)
+    from chain c
+    left join system_messages s on c.role = 'system' and s.id = c.message_id
+    left join user_messages u on c.role = 'user' and u.id = c.message_id
+    left join llm_messages l on c.role = 'assistant' and l.id = c.message_id
+    order by c.depth;
+$$;
+
+create index if not exists ix_message_nodes_parent_id on message_nodes (parent_id);
@@ -3,11 +3,14 @@
 
 
 from src.database import DB_utils
-import json, os
+from src.database.message_tree import MessageTree
+from src.models.context_window import ContextWindow
+import json, os, logging
 from typing import Dict, Any
 
-db_handle = DB_utils.DBHandlerAd("data/app.db")
+db_handle = DB_utils.DBHandlerAd("data/app.db", persistent=True, profile=DB_utils.load_db_profile())
 user_id = 1
+logger = logging.getLogger(__name__)
 
 import requests
 import json
@@ -15,6 +18,10 @@ import os
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
+MODEL = "openai/gpt-3.5-turbo"
+# 毎ターン履歴を全部送るとプロンプトが際限なく伸びるので、モデルの枠に収まるよう古いターンから落とす
+context_window = ContextWindow(MODEL)
+
 def get_response(history):
     response = requests.post(
     url="https://openrouter.ai/api/v1/chat/completions",
@@ -22,7 +29,7 @@ def get_response(history):
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
     },
     data=json.dumps({
-        "model": "openai/gpt-3.5-turbo", # Optional
+        "model": MODEL, # Optional
         "messages":history
     })
     )
@@ -51,24 +58,16 @@ def extract_meta_data(data: Dict[str, Any], content:str) -> Dict[str, Any]:
     }
 
 def main(first_system_message:dict, db_handle :DB_utils.DBHandler):
-    id_branch = []
+    tree = MessageTree(db_handle)
+    tree.migrate()
     history = []
     state = True
+    system_content = None
     if first_system_message:
         history.append(first_system_message)
+        system_content = first_system_message['content']
+    branch_id = tree.create_branch(user_id, system_content)
 
-        fsm_id = db_handle.insert_data(
-            "system_messages",
-            {"user_id":user_id, "content":first_system_message['content']},
-            last_id=True
-            )
-        id_branch.append({"system":fsm_id})
-        branch_id = db_handle.insert_json(
-            "branches",
-            id_branch,
-            last_id=True
-            )
-        
     while state == True:
         input_ = input("you :")
         if input_ == "終了":
@@ -77,15 +76,9 @@ def main(first_system_message:dict, db_handle :DB_utils.DBHandler):
         user_message_dict = {"role":"user", "content":input_}
         history.append(user_message_dict)
 
-        recent_m_id = db_handle.insert_data(
-            "user_messages",
-            {"user_id":user_id, "content":input_},
-            last_id= True
-            )
-        id_branch.append({"user":recent_m_id})
-        db_handle.update_data("branches", {"json_data":id_branch}, {"id":branch_id})
-
-        resp = get_response(history)
+        fitted = context_window.fit(history)
+        logger.debug(f"prompt tokens (estimated): {fitted.prompt_tokens}")
+        resp = get_response(fitted.messages)
         llm_content = resp["choices"][0]["message"]["content"]
         print(llm_content)
         history.append({"role":"assistant", "content":llm_content})
@@ -93,13 +86,10 @@ def main(first_system_message:dict, db_handle :DB_utils.DBHandler):
         resp_dict = extract_meta_data(resp, llm_content)
         resp_dict |= {"user_id":user_id}
 
-        recent_l_id = db_handle.insert_data(
-            "llm_messages",
-            resp_dict,
-            last_id=True
-            )
-        id_branch.append({"assistant":recent_l_id})
-        db_handle.update_data("branches", {"json_data":id_branch}, {"id":branch_id})
+        # 1ターン分の書き込みはまとめて1回のcommitにする。ブランチへの追加はノード1行ずつで済む
+        with db_handle.transaction():
+            tree.append_message(branch_id, "user", {"user_id":user_id, "content":input_})
+            tree.append_message(branch_id, "assistant", resp_dict)
 
 main({"role":"system", "content":"あなたは優秀なアシスタントです"}, db_handle)
 
@@ -0,0 +1,70 @@
+"""
+Compare the JSON backends of src.models.stream_json on a recorded OpenRouter stream.
+
+Record a stream with e.g.
+    curl -sN https://openrouter.ai/api/v1/chat/completions \
+        -H "Authorization: Bearer $OPENROUTER_API_KEY" -H "Content-Type: application/json" \
+        -d '{"model": "openai/gpt-3.5-turbo", "stream": true, "messages": [...]}' > stream.txt
+and run
+    python -m others.temporary.bench_stream_json stream.txt [more.txt ...]
+
+Without arguments a synthetic Japanese stream with the same chunk shape is used.
+"""
+import json
+import sys
+import time
+
+from src.models.sse import SSEDecoder
+from src.models.stream_json import ChunkDecoder, available_backends
+
+
+def synthetic_stream(n_chunks: int = 2000) -> bytes:
+    parts = [b": OPENROUTER PROCESSING\n\n"]
+    for i in range(n_chunks):
+        chunk = {
+            "id": "gen-bench",
+            "provider": "OpenAI",
+            "model": "openai/gpt-3.5-turbo",
+            "object": "chat.completion.chunk",
+            "created": 1720000000,
+            "choices": [{"index": 0, "delta": {"role": "assistant", "content": "日本語の応答"}, "finish_reason": None, "logprobs": None}],
+            "system_fingerprint": None,
+        }
+        parts.append(b"data: " + json.dumps(chunk, ensure_ascii=False).encode() + b"\n\n")
+    usage = {"id": "gen-bench", "model": "openai/gpt-3.5-turbo", "choices": [{"index": 0, "delta": {"content": ""}, "finish_reason": "stop"}],
+             "usage": {"prompt_tokens": 20, "completion_tokens": n_chunks, "total_tokens": n_chunks + 20}}
+    parts.append(b"data: " + json.dumps(usage).encode() + b"\n\n")
+    parts.append(b"data: [DONE]\n\n")
+    return b"".join(parts)
+
+
+def payloads(stream: bytes) -> list[str]:
+    events = SSEDecoder().feed(stream)
+    return [event.data for event in events if event.data != "[DONE]"]
+
+
+def bench(backend: str, data: list[str], repeat: int = 20) -> float:
+    decoder = ChunkDecoder(backend)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for payload in data:
+            decoder.decode(payload)
+        best = min(best, time.perf_counter() - start)
+    return best / len(data)
+
+
+def main() -> None:
+    streams = [(path, open(path, "rb").read()) for path in sys.argv[1:]] or [("synthetic", synthetic_stream())]
+    for name, stream in streams:
+        data = payloads(stream)
+        print(f"{name}: {len(data)} chunks")
+        baseline = None
+        for backend in available_backends()[::-1]:
+            per_chunk = bench(backend, data)
+            baseline = baseline or per_chunk
+            print(f"  {backend:8s} {per_chunk * 1e6:8.2f} us/chunk  x{baseline / per_chunk:.2f}")
+
+
+if __name__ == "__main__":
+    main()
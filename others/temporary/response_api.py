@@ -5,9 +5,17 @@ import httpx
 import json
 import os
 from typing import List, Dict, Any, Optional, AsyncGenerator, Union
-from fastapi.responses import StreamingResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
-app = FastAPI()
+from src.models.http_pool import get_default_pool, pool_lifespan
+from src.models.metrics import MetricsRecorder
+from src.models.sse import aiter_sse
+
+# 共有のHTTP/2クライアントは起動時に作り、終了時に閉じる
+app = FastAPI(lifespan=pool_lifespan)
+
+# モデルごとのTTFT・所要時間・トークン使用量。/metricsでPrometheus形式で見られる
+metrics = MetricsRecorder()
 
 app.add_middleware(
     CORSMiddleware,
@@ -39,46 +47,54 @@ class LLMClient:
     async def post_chat_completion(
         self, messages: List[Dict[str, str]], stream: bool = False
     ) -> Union[Dict[str, Any], AsyncGenerator[str, None]]:
-        async with httpx.AsyncClient(http2=True) as client:
-            data = {"model": self.model, "messages": messages, "stream": stream}
-
-            if stream:
-                return self._stream_response(client, data)
-            else:
-                try:
-                    response = await client.post(
-                        self.url, headers=self.headers, json=data
-                    )
-                    response.raise_for_status()
-                    return response.json()
-                except httpx.HTTPError as e:
-                    print(f"An HTTP error occurred while making the request: {e}")
-                    return {}
-                except Exception as e:
-                    print(f"An unexpected error occurred: {e}")
-                    return {}
+        client = get_default_pool().get_client()
+        data = {"model": self.model, "messages": messages, "stream": stream}
+
+        if stream:
+            return self._stream_response(client, data)
+        else:
+            tracker = metrics.start_request(self.model)
+            try:
+                response = await client.post(
+                    self.url, headers=self.headers, json=data
+                )
+                response.raise_for_status()
+                response_data = response.json()
+                usage = response_data.get("usage") or {}
+                tracker.usage({"id": response_data.get("id"), **usage})
+                tracker.finish()
+                return response_data
+            except httpx.HTTPError as e:
+                tracker.finish(error=True)
+                print(f"An HTTP error occurred while making the request: {e}")
+                return {}
+            except Exception as e:
+                tracker.finish(error=True)
+                print(f"An unexpected error occurred: {e}")
+                return {}
 
     async def _stream_response(
         self, client: httpx.AsyncClient, data: Dict[str, Any]
     ) -> AsyncGenerator[str, None]:
+        tracker = metrics.start_request(self.model)
+        error = True
         try:
             async with client.stream(
                 "POST", self.url, headers=self.headers, json=data
             ) as response:
                 response.raise_for_status()
-                buffer = ""
-                async for raw_chunk in response.aiter_raw():
-                    buffer += raw_chunk.decode("utf-8")
-                    while "\n" in buffer:
-                        chunk, buffer = buffer.split("\n", 1)
-                        if chunk.strip():
-                            parsed = self._parse_chunk(chunk)
-                            if parsed:
-                                yield parsed
+                async for event in aiter_sse(response.aiter_bytes()):
+                    parsed = self._parse_chunk(event.data)
+                    if parsed:
+                        tracker.token()
+                        yield parsed
+            error = False
         except httpx.HTTPError as e:
             print(f"An HTTP error occurred while streaming the response: {e}")
         except Exception as e:
             print(f"An unexpected error occurred while streaming: {e}")
+        finally:
+            tracker.finish(error=error)
 
     @staticmethod
     def _parse_chunk(chunk: str) -> str:
@@ -126,6 +142,11 @@ async def chat(request: ChatRequest):
             raise HTTPException(status_code=500, detail="Failed to get a response")
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     import uvicorn
 
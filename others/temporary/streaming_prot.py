@@ -1,14 +1,45 @@
 import os
 import json
+import logging
+from contextlib import asynccontextmanager
+
 import httpx
 from fastapi import FastAPI, WebSocket
 from fastapi.responses import HTMLResponse
 
-app = FastAPI()
+from src.database.async_db import AsyncDBHandler
+from src.database.DB_utils import load_db_profile, load_schemas, load_settings
+from src.database.write_behind import WriteBehindQueue
+from src.models.context_window import ContextWindow, TokenCounter
+from src.models.sse import aiter_sse
+
+logger = logging.getLogger(__name__)
+
+schemas = load_schemas("config/db_schema")
+# 書き込みは専用スレッド、読み込みはスレッドプールで行うので、イベントループは止まらない
+# PRAGMAのプロファイルはconfig/settings.yamlのdatabase.profileで切り替える
+db_handle = AsyncDBHandler(load_settings()["database"]["path"], schemas=schemas, profile=load_db_profile())
+writer = WriteBehindQueue(db_handle)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    for schema in schemas.values():
+        await db_handle.migrate_table(schema)
+    # 書き込みはバックグラウンドでまとめて行い、終了時に残りを書き切る
+    async with writer:
+        yield
+    await db_handle.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # APIキーを環境変数から取得
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
+# 接続をまたいで使い回す。同じメッセージのトークン数は一度しか数えない
+token_counter = TokenCounter()
+
 # HTMLのインターフェースを提供（オプション）
 html = """
 <!DOCTYPE html>
@@ -106,6 +137,11 @@ async def websocket_endpoint(websocket: WebSocket):
             user_input = message_data["text"]
             selected_model = message_data["model"]
             conversation_history.append({"role": "user", "content": user_input})
+            # キューに積むだけなので、最初のトークンが届くまでの時間には影響しない
+            await writer.put("user_messages", {"user_id": None, "content": user_input})
+            # モデルごとの枠に収まるよう古いターンを落としてから送る
+            fitted = ContextWindow(selected_model, counter=token_counter).fit(conversation_history)
+            logger.debug(f"prompt tokens (estimated): {fitted.prompt_tokens}, dropped: {len(fitted.dropped)}")
 
             async with client.stream(
                 "POST",
@@ -116,17 +152,20 @@ async def websocket_endpoint(websocket: WebSocket):
                 },
                 json={
                     "model": selected_model,
-                    "messages": conversation_history,
+                    "messages": fitted.messages,
                     "stream": True,
                 },
             ) as response:
                 assistant_reply = ""
+                gen_id = None
+                usage = {}
                 first_chunk = True
-                async for line in response.aiter_lines():
-                    if line.startswith("data: "):
+                async for event in aiter_sse(response.aiter_bytes()):
+                    if event.data != "[DONE]":
                         try:
-                            json_data = line[len("data: ") :]
-                            data = json.loads(json_data)
+                            data = json.loads(event.data)
+                            gen_id = data.get("id", gen_id)
+                            usage = data.get("usage") or usage
                             if (
                                 "delta" in data["choices"][0]
                                 and "content" in data["choices"][0]["delta"]
@@ -152,6 +191,17 @@ async def websocket_endpoint(websocket: WebSocket):
                 conversation_history.append(
                     {"role": "assistant", "content": assistant_reply}
                 )
+                await writer.put(
+                    "llm_messages",
+                    {
+                        "gen_id": gen_id,
+                        "user_id": None,
+                        "model": selected_model,
+                        "content": assistant_reply,
+                        "prompt_tokens": usage.get("prompt_tokens"),
+                        "completion_tokens": usage.get("completion_tokens"),
+                    },
+                )
                 print(conversation_history)
 
 
@@ -3,11 +3,25 @@
 DBHandler
     data_exists             :特定のデータが存在しているかを先にverify
     insert_data             :上と連携して、データinsert時に重複があった場合はスキップできる関数
+    insert_many             :大量のデータをexecutemanyで1つのトランザクションにまとめて挿入する関数
+    upsert_data             :スキーマのuniqueキーで衝突したら既存のレコードを更新する関数
     select_one_record       :任意のレコード(列)を取り出す関数
     count_data              :対象テーブルにどれだけデータが格納されてるかをintで返す
+    iter_rows               :テーブルの行をidの順にページ単位で読み出すジェネレータ(全件をメモリに載せない)
     get_columns             :対象テーブルのカラムを返す
     create_table            :与えられたスキーマに従ってテーブルを作る関数
+    create_indexes          :スキーマの"indexes"と"unique"に従ってインデックスを張る
+    migrate_table           :既存のDBのテーブルにスキーマで増えたカラムとインデックスを追加する
     table_exists            :指定した名前のテーブルが存在するか量る
+    fetch_all               :パラメータ付きの任意のSELECTを実行して全行を返す
+    execute                 :パラメータ付きの任意の更新系SQLを実行して影響した行数を返す
+    register_schema         :スキーマ(uniqueキーなど)をハンドラに覚えさせる
+    transaction             :with文の中の処理をまとめて1回のcommitにするコンテキストマネージャ
+    close                   :persistentモードで保持しているコネクションを閉じる
+
+load_db_profile             :config/settings.yamlからSQLiteのPRAGMAのプロファイル(safe/balanced/fast)を読み込む
+
+SQL文はquery_builder.QueryBuilder(self.queries)で組み立てる。値はすべてパラメータで渡し、識別子はスキーマと照合する。
 
 DBHandlerAd
     drop_table              :任意のテーブルを削除する
@@ -15,50 +29,357 @@ DBHandlerAd
 '''
 
 
-import sqlite3, json
+import sqlite3, json, threading, os, warnings
+from contextlib import contextmanager
+
+import yaml
+
+from .query_builder import QueryBuilder
+
+
+# settings.yamlに無くても使えるように、同じ内容を既定値として持っておく
+DB_PROFILES = {
+    # 1回のcommitごとにfsync。電源断でもcommit済みのデータは失われない
+    "safe": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "busy_timeout": 5000,
+        "cache_size": -8000,
+        "temp_store": "DEFAULT",
+        "mmap_size": 0,
+    },
+    # WALならNORMALでもDBは壊れない。電源断で直前のcommitが失われることがあるだけ
+    "balanced": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -32000,
+        "temp_store": "MEMORY",
+        "mmap_size": 268435456,
+    },
+    # fsyncしない。消えても作り直せるデータ(キャッシュ、検証用)向け
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "busy_timeout": 10000,
+        "cache_size": -64000,
+        "temp_store": "MEMORY",
+        "mmap_size": 1073741824,
+    },
+}
+DEFAULT_DB_PROFILE = "balanced"
+# busy_timeoutを最初に設定して、journal_modeの切り替えがロック待ちで即失敗しないようにする
+PRAGMA_ORDER = ("busy_timeout", "journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store")
+
+
+def load_schema(path :str) -> dict:
+    """
+    config/db_schema/*.jsonのスキーマを1つ読み込む
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def load_schemas(schema_dir :str) -> dict:
+    """
+    ディレクトリ内のスキーマをすべて読み込み、テーブル名をキーにした辞書で返す
+    """
+    schemas = {}
+    for file_name in sorted(os.listdir(schema_dir)):
+        if file_name.endswith(".json"):
+            schema = load_schema(os.path.join(schema_dir, file_name))
+            schemas[schema["table_name"]] = schema
+    return schemas
+
+def index_definitions(schema :dict, table_name :str = None) -> list:
+    """
+    スキーマからインデックスの定義を (インデックス名, カラムのタプル, uniqueか) のリストで返す。
+    "indexes": [{"columns": ["user_id"]}, {"name": "...", "columns": ["a", "b"], "unique": true}]
+    nameを省略した場合は ix_テーブル名_カラム名 (uniqueなら uq_...) になる。
+    "unique"に書いたキーもユニークインデックスとして含まれる。
+    """
+    table_name = table_name or schema["table_name"]
+    definitions = []
+    for key in unique_keys(schema):
+        definitions.append((f"uq_{table_name}_{'_'.join(key)}", key, True))
+    for index in schema.get("indexes", []):
+        columns = tuple(index["columns"])
+        unique = index.get("unique", False)
+        prefix = "uq" if unique else "ix"
+        name = index.get("name", f"{prefix}_{table_name}_{'_'.join(columns)}")
+        definitions.append((name, columns, unique))
+    return definitions
+
+def chunk_rows(rows, chunk_size :int):
+    """
+    dictのiterableを、カラム構成が同じ行ごとに最大chunk_size件ずつまとめる。
+    (カラムのタプル, 値のタプルのリスト) を順に返すジェネレータ。
+    """
+    columns, chunk = None, []
+    for row in rows:
+        row_columns = tuple(row.keys())
+        if chunk and (row_columns != columns or len(chunk) >= chunk_size):
+            yield columns, chunk
+            chunk = []
+        columns = row_columns
+        chunk.append(tuple(row.values()))
+    if chunk:
+        yield columns, chunk
+
+def unique_keys(schema :dict) -> list:
+    """
+    スキーマの"unique"からユニークキーをタプルのリストで返す。
+    "unique": ["gen_id", ["user_id", "content"]] のように、単一カラムは文字列、複合キーはリストで書く。
+    """
+    keys = []
+    for key in schema.get("unique", []):
+        keys.append((key,) if isinstance(key, str) else tuple(key))
+    return keys
+
+def load_settings(path :str = "config/settings.yaml") -> dict:
+    """
+    config/settings.yamlを読み込む。ファイルが無いか空の場合は空の辞書を返す
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as file:
+        return yaml.safe_load(file) or {}
+
+def load_db_profile(name :str = None, settings_path :str = "config/settings.yaml") -> dict:
+    """
+    SQLiteのPRAGMAのプロファイルを辞書で返す。DBHandler(profile=...)に渡す。
+    name : safe / balanced / fast など。省略するとsettings.yamlのdatabase.profile、それも無ければbalanced。
+    settings.yamlのdatabase.profilesに書いた値は既定値(DB_PROFILES)を上書きする。
+    """
+    database = load_settings(settings_path).get("database") or {}
+    name = name or database.get("profile") or DEFAULT_DB_PROFILE
+    profiles = {key: dict(value) for key, value in DB_PROFILES.items()}
+    for key, value in (database.get("profiles") or {}).items():
+        profiles.setdefault(key, {}).update(value or {})
+    if name not in profiles:
+        raise ValueError(f"Unknown database profile: {name}")
+    return profiles[name]
+
+def pragma_statements(profile :dict) -> list:
+    """
+    プロファイルからPRAGMA文のリストを作る。値は埋め込むので、知らないキーや不正な値はここで弾く
+    """
+    unknown = set(profile) - set(PRAGMA_ORDER)
+    if unknown:
+        raise ValueError(f"Unsupported pragma: {', '.join(sorted(unknown))}")
+    statements = []
+    for key in PRAGMA_ORDER:
+        if key not in profile:
+            continue
+        value = profile[key]
+        if not isinstance(value, int) and not str(value).isalnum():
+            raise ValueError(f"Invalid value for pragma {key}: {value!r}")
+        statements.append(f"PRAGMA {key}={value};")
+    return statements
 
 #下の関数はDBに接続するためのデコレータ
 def db_connection(func):
     def wrapper(self, *args, **kwargs):
-        # コネクションが既に開かれているかチェック
-        if not hasattr(self, 'conn') or self.conn is None:
-            new_connection = True
-            self.conn = sqlite3.connect(self.db_path)
-            self.cur = self.conn.cursor()
-        else:
-            new_connection = False
+        # コネクションが既に開かれているかチェック(transaction中やメソッドの入れ子呼び出し)
+        if self.conn is not None:
+            return func(self, *args, **kwargs)
 
-        try:
+        with self._borrow_connection():
             return func(self, *args, **kwargs)
-        finally:
-            if new_connection:
-                self.conn.commit()
-                self.cur.close()
-                self.conn.close()
-                del self.cur
-                del self.conn
     return wrapper
 
 #したの関数はエラーハンドリングを追加するデコレータ
 def error_handling(func):
+    # transactionの中ではエラーを握りつぶすと途中までの書き込みがcommitされてしまうので、投げ直してrollbackさせる
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except sqlite3.Error as e:
             print(f"{func.__name__}のメソッドにてエラー")
             print(f"An error occurred: {e}")
+            if args and getattr(args[0], "in_transaction", False):
+                raise
         except Exception as e:
             print(f"{func.__name__}のメソッドにてエラー")
             print(f"An unexpected error occurred: {e}")
+            if args and getattr(args[0], "in_transaction", False):
+                raise
     return wrapper
 
 ########こっからhandler部分########
 class DBHandler:
-    def __init__(self, db_path) -> None:
+    def __init__(self, db_path, persistent :bool = False, schemas :dict = None, profile = None) -> None:
         """
         db_pathで接続先を設定。絶対パスを入れてネ
+        persistent : Trueにするとスレッドごとにコネクションを使い回す。毎回のconnect/closeを省ける。
+        schemas : load_schemasで読み込んだスキーマ。uniqueキーを使った重複チェックに使う。
+        profile : コネクションを作るたびに適用するPRAGMA。"balanced"のようなプロファイル名か、load_db_profileの戻り値の辞書。
+                  Noneならsqlite3の既定のまま(AsyncDBHandlerも同じ)。settings.yamlで選んだものを使うならload_db_profile()を渡す。
+                  複数のワーカーで同じDBを使うならWALのプロファイルにすること。
         """
         self.db_path = db_path
+        self.persistent = persistent
+        if isinstance(profile, str):
+            profile = load_db_profile(profile)
+        self.profile = profile or {}
+        self._pragmas = pragma_statements(self.profile)
+        self.schemas = {}
+        self.queries = QueryBuilder(self.schemas)    # schemasは同じ辞書を共有するので、登録したスキーマで識別子が検査される
+        self._unique_indexes = {}   # テーブル名 -> 実際に張られているユニークインデックスのカラムの組(PRAGMAで調べた結果)
+        for schema in (schemas or {}).values():
+            self.register_schema(schema)
+        self._local = threading.local()
+        self._persistent_conns = []
+        self._persistent_lock = threading.Lock()
+
+    # conn/curはスレッドごとに持つ(同じハンドラを複数スレッドから使っても混ざらないように)
+    @property
+    def conn(self):
+        return getattr(self._local, "conn", None)
+
+    @conn.setter
+    def conn(self, value):
+        self._local.conn = value
+
+    @property
+    def cur(self):
+        return getattr(self._local, "cur", None)
+
+    @cur.setter
+    def cur(self, value):
+        self._local.cur = value
+
+    @property
+    def in_transaction(self) -> bool:
+        """
+        このスレッドでtransaction()の中にいるか。中ではメソッドのエラーが握りつぶされずに例外になる。
+        """
+        return getattr(self._local, "transaction", False)
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        新しいコネクションを作る。コネクションの設定はここにまとめる。
+        """
+        # busy_timeoutはconnectのtimeoutにも渡して、PRAGMAを流す前からロック待ちが効くようにする
+        timeout = self.profile.get("busy_timeout", 5000) / 1000
+        conn = sqlite3.connect(self.db_path, timeout=timeout, check_same_thread=not self.persistent)
+        for statement in self._pragmas:
+            conn.execute(statement)
+        return conn
+
+    def _persistent_connection(self) -> sqlite3.Connection:
+        """
+        このスレッド用の使い回しコネクションを返す。無ければ作る。
+        """
+        conn = getattr(self._local, "persistent_conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.persistent_conn = conn
+            with self._persistent_lock:
+                self._persistent_conns.append(conn)
+        return conn
+
+    @contextmanager
+    def _borrow_connection(self):
+        """
+        コネクションを借りてself.conn/self.curにセットし、抜けるときにcommitする。
+        例外が出た場合はrollbackする。persistentでなければ最後にcloseする。
+        """
+        conn = self._persistent_connection() if self.persistent else self._connect()
+        self.conn = conn
+        self.cur = conn.cursor()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self.cur.close()
+            self.cur = None
+            self.conn = None
+            if not self.persistent:
+                conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        with文の中で呼んだメソッドを1つのコネクション・1回のcommitにまとめる。
+        例外で抜けた場合はrollbackされる。入れ子で使った場合は外側のtransactionにまとめられる。
+        中で呼んだメソッドのエラーは(error_handlingで握りつぶされずに)例外として投げられ、ブロック全体がrollbackされる。
+
+        with db_handle.transaction():
+            db_handle.insert_data(...)
+            db_handle.update_data(...)
+        """
+        if self.conn is not None:
+            yield self
+            return
+        self._local.transaction = True
+        try:
+            with self._borrow_connection():
+                yield self
+        finally:
+            self._local.transaction = False
+
+    def register_schema(self, schema :dict, table_name :str = None) -> None:
+        """
+        スキーマを覚えさせる。create_tableを呼んだテーブルは自動で登録される。
+        """
+        self.schemas[table_name or schema["table_name"]] = schema
+
+    def _unique_key(self, table_name :str, data :dict, check_columns :list = None) -> tuple:
+        """
+        check_columnsに対応する、スキーマで宣言されたuniqueキーを探す。見つからなければNoneを返す。
+        check_columnsが無い場合は、dataに全カラムが含まれている最初のuniqueキーを使う。
+        """
+        schema = self.schemas.get(table_name)
+        if schema is None:
+            return None
+        for key in unique_keys(schema):
+            if check_columns is None:
+                if all(col in data for col in key):
+                    return key
+            elif set(key) == set(check_columns):
+                return key
+        return None
+
+    def _has_unique_index(self, table_name :str, key :tuple) -> bool:
+        """
+        keyのカラムにユニークインデックスが実際に張られているかを返す。コネクションを借りている間に呼ぶこと。
+        PRAGMA index_listで調べた結果はテーブルごとに覚えておき、create_indexesで張り直したときに捨てる。
+        """
+        indexes = self._unique_indexes.get(table_name)
+        if indexes is None:
+            self.queries.validate(table_name)
+            indexes = set()
+            for index in self.conn.execute(f"PRAGMA index_list({table_name});").fetchall():
+                # (seq, name, unique, origin, partial)。部分インデックスはON CONFLICTの対象にできない
+                if index[2] and not (len(index) > 4 and index[4]):
+                    info = self.conn.execute(f"PRAGMA index_info({index[1]});").fetchall()
+                    indexes.add(frozenset(row[2] for row in info))
+            self._unique_indexes[table_name] = indexes
+        return frozenset(key) in indexes
+
+    def _conflict_key(self, table_name :str, data :dict, check_columns :list = None) -> tuple:
+        """
+        ON CONFLICTに使えるuniqueキーを返す。スキーマで宣言されていても、DBにインデックスが無ければNone
+        (マイグレーション前のDBや、重複データのせいでインデックスが張れなかった場合)。
+        Noneのときはdata_existsでの確認に戻す。
+        """
+        key = self._unique_key(table_name, data, check_columns)
+        if key is None or not self._has_unique_index(table_name, key):
+            return None
+        return key
+
+    def close(self) -> None:
+        """
+        persistentモードで開いたコネクションをすべて閉じる。
+        """
+        with self._persistent_lock:
+            conns, self._persistent_conns = self._persistent_conns, []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
 
     @db_connection
     @error_handling
@@ -70,9 +391,8 @@ class DBHandler:
         if check_columns is None:
             check_columns = data.keys()
 
-        query = f"SELECT * FROM {table_name} WHERE " + " AND ".join([f"{k} = ?" for k in check_columns])
-        check_values = [data[k] for k in check_columns]
-        self.cur.execute(query, tuple(check_values))
+        query, params = self.queries.exists(table_name, {k: data[k] for k in check_columns})
+        self.cur.execute(query, params)
         exists = self.cur.fetchone() is not None
         if exists:
             return True
@@ -92,49 +412,153 @@ class DBHandler:
         table_name : isnert先のテーブルを指定。テーブルが存在していないとエラーになる。
         data : isnertしたいデータ。キーにテーブルのカラム名、バリューに実際に挿入したいデータを入れる。
         check_columns : 挿入したいデータがすこの指定されたリストの中のカラムに含まれる場合は挿入を飛ばす。指定しない場合、すべてのカラムが検証される。
+                        スキーマにuniqueキーが宣言されている場合はそれを使い、INSERT ... ON CONFLICT DO NOTHINGの1文で済ませる。
         hard : Trueを入れると、データの検証を飛ばし、データの有無に関わらず挿入する。
         """
+        conflict_key = None
         if not hard:
-            if self.data_exists(table_name, data, check_columns) == True:
+            # uniqueキーがあれば、重複チェックと挿入を1つの文で済ませる
+            conflict_key = self._conflict_key(table_name, data, check_columns)
+            # インデックスが無くてON CONFLICTが使えないときも、宣言されたuniqueキーで重複を確かめる。
+            # ユニークインデックスと同じく、NULLを含むキーは重複とみなさない
+            unique_key = None if check_columns else self._unique_key(table_name, data)
+            null_key = unique_key is not None and any(data[col] is None for col in unique_key)
+            if not conflict_key and not null_key and self.data_exists(table_name, data, check_columns or unique_key) == True:
                 print("Data already exists with specified columns, skipping insert.")
                 return False
-        columns = ",".join(data.keys())
-        values = ",".join(["?"] * len(data))
-        query = f"INSERT INTO {table_name} ({columns}) VALUES ({values});"
+        query = self.queries.insert(table_name, tuple(data.keys()), conflict_key)
         self.cur.execute(query, tuple(data.values()))
+        if self.cur.rowcount == 0:
+            print("Data already exists with specified columns, skipping insert.")
+            return False
         if last_id:
             last_id = self.cur.lastrowid
             return last_id
         else:
             return True
-        
+
+    @error_handling
+    def insert_many(self,
+                    table_name :str,
+                    rows,
+                    returning_ids :bool = False,
+                    chunk_size :int = 1000,
+                    hard :bool = False
+                    ):
+        """
+        概要 : 大量のデータをまとめて挿入するメソッド。全体を1つのトランザクションで行い、commitは最後の1回だけ。
+        table_name : insert先のテーブルを指定。
+        rows : 挿入したいdictのiterable。ジェネレータも渡せるので、全件をメモリに載せる必要はない。
+        returning_ids : Trueを入れると、各行のrowidをリストで返す(重複でスキップされた行はNone)。
+                        executemanyが使えず1行ずつのexecuteになるので、必要なときだけ使う。
+        chunk_size : executemanyに一度に渡す行数。
+        hard : Trueを入れると、uniqueキーによる重複チェックを飛ばす。
+        戻り値 : returning_idsがFalseなら挿入した件数。
+        """
+        inserted = [] if returning_ids else 0
+        with self.transaction():
+            for columns, chunk in chunk_rows(rows, chunk_size):
+                conflict_key = None if hard else self._conflict_key(table_name, dict.fromkeys(columns))
+                query = self.queries.insert(table_name, columns, conflict_key, returning=returning_ids)
+
+                unique_key = None if hard or conflict_key else self._unique_key(table_name, dict.fromkeys(columns))
+                if unique_key:
+                    # インデックスが無くてON CONFLICTが使えないので、1行ずつdata_existsで確かめてから入れる
+                    # (ユニークインデックスと同じく、NULLを含むキーは重複とみなさない)
+                    for values in chunk:
+                        data = dict(zip(columns, values))
+                        if all(data[col] is not None for col in unique_key) and self.data_exists(table_name, data, list(unique_key)):
+                            if returning_ids:
+                                inserted.append(None)
+                            continue
+                        self.cur.execute(query, values)
+                        if returning_ids:
+                            inserted.append(self.cur.fetchone()[0])
+                        else:
+                            inserted += 1
+                elif returning_ids:
+                    for values in chunk:
+                        self.cur.execute(query, values)
+                        row = self.cur.fetchone()
+                        inserted.append(row[0] if row else None)
+                else:
+                    self.cur.executemany(query, chunk)
+                    inserted += self.cur.rowcount
+        return inserted
 
     @db_connection
     @error_handling
-    def select_one_record(self, table_name :str, conditions :str = None, fields :str = None) -> tuple:
+    def upsert_data(self,
+                    table_name :str,
+                    data :dict,
+                    conflict_columns :list = None,
+                    update_columns :list = None,
+                    last_id :bool = False
+                    ) -> bool:
+        """
+        概要 : 挿入しようとしたデータがuniqueキーで衝突した場合、既存のレコードを更新するメソッド。
+        table_name : insert先のテーブルを指定。
+        data : insertしたいデータ。キーにテーブルのカラム名、バリューに実際に挿入したいデータを入れる。
+        conflict_columns : 衝突を判定するカラム。指定しない場合はスキーマのuniqueキーを使う。
+        update_columns : 衝突したときに更新するカラム。指定しない場合は衝突判定以外のすべてのカラム。
+        last_id : Trueを入れると、挿入もしくは更新されたレコードのrowidを返す。
+        """
+        conflict_key = tuple(conflict_columns) if conflict_columns else self._conflict_key(table_name, data)
+        if not conflict_key:
+            raise ValueError(f"{table_name}にuniqueキーが宣言されていないか、そのインデックスが無いため(migrate_tableで張れる)、conflict_columnsを指定してください")
+        if update_columns is None:
+            update_columns = [k for k in data.keys() if k not in conflict_key]
+
+        query = self.queries.upsert(table_name, tuple(data.keys()), conflict_key, tuple(update_columns))
+        self.cur.execute(query, tuple(data.values()))
+        row = self.cur.fetchone()
+        if last_id:
+            return row[0] if row else None
+        return row is not None
+
+
+    @db_connection
+    @error_handling
+    def select_one_record(self, table_name :str, conditions :dict = None, fields :str = None) -> tuple:
         """
         概要 : レコード(行)を一列取り出してくれるメソッド。
         table_name : isnert先のテーブルを指定。テーブルが存在していないとエラーになる。
-        data : isnertしたいデータ。キーにテーブルのカラム名、バリューに実際に挿入したいデータを入れる。
-        fields : 引きたいデータのカラムを指定する。
+        conditions : 取り出す条件。{"id": 3} のようにカラム名と値の辞書で渡す(値はパラメータとして渡される)。
+                     "id = 3" のような文字列も使えるが、SQLインジェクションの危険があるので非推奨。
+        fields : 引きたいデータのカラムを指定する。"id, content" か ["id", "content"]。
         """
-        query = f"SELECT {fields or '*'} FROM {table_name}"
-        if conditions:
-            query += f" WHERE {conditions}"
-            
-        self.cur.execute(query)
+        if isinstance(conditions, str):
+            query, params = self._raw_conditions_query(self.queries.select(table_name, fields)[0], conditions)
+        else:
+            query, params = self.queries.select(table_name, fields, conditions)
+        self.cur.execute(query, params)
         record = self.cur.fetchone()
         return record
+
+    @staticmethod
+    def _raw_conditions_query(query :str, conditions :str) -> tuple:
+        """
+        文字列のconditionsを付けたSQLを返す。古い呼び出し方の互換用。
+        """
+        warnings.warn(
+            "String conditions are deprecated; pass a dict such as {\"id\": 3} instead.",
+            DeprecationWarning,
+            stacklevel=5,
+        )
+        if conditions:
+            query = query.rstrip(";") + f" WHERE {conditions};"
+        return query, ()
     
     @db_connection
     @error_handling
-    def count_data(self, table_name :str) -> int:
+    def count_data(self, table_name :str, conditions :dict = None) -> int:
         """
         概要 : 対象のテーブルのレコード数をカウントしてくれるメソッド。
         table_name : データのカウントする対象
+        conditions : 指定すると、条件({"user_id": 1}など)に合うレコードだけを数える。
         """
-        sql_select = f'SELECT COUNT(*) FROM {table_name};'
-        self.cur.execute(sql_select)
+        sql_select, params = self.queries.count(table_name, conditions)
+        self.cur.execute(sql_select, params)
 
         result = self.cur.fetchone()
         if result:
@@ -153,6 +577,40 @@ class DBHandler:
         columns = [tup[1] for tup in self.cur.fetchall()]
         return columns
         
+    @db_connection
+    def _fetch_page(self, table_name :str, where :dict, columns, key :str, after, batch_size :int) -> list:
+        """
+        iter_rowsの1ページ分。ページごとにコネクションを借りるので、読み出しの途中で長くロックを持たない。
+        失敗したページを空のページと区別できるよう、error_handlingは付けずに例外をそのまま投げる。
+        """
+        query, params = self.queries.page(table_name, columns, where, key, after, batch_size)
+        self.cur.execute(query, params)
+        return self.cur.fetchall()
+
+    def iter_rows(self, table_name :str, where :dict = None, columns = None, batch_size :int = 1000, key :str = "id"):
+        """
+        概要 : テーブルの行をkey(既定はid)の昇順に1行ずつ返すジェネレータ。エクスポートや集計用。
+        batch_size行ずつキーセットページング(WHERE id > 前のページの最後 ORDER BY id LIMIT ...)で読むので、
+        テーブルがどれだけ大きくても、メモリに載るのは1ページ分だけ。
+        where : {"user_id": 1} のような条件の辞書。
+        columns : 取り出すカラム。"id, content" か ["id", "content"]。省略すると全カラム。
+        key : ページングに使う、一意で増えていくカラム(インデックスがあること)。
+        途中で失敗した場合は、エクスポートが黙って欠けないよう例外をそのまま投げる。
+
+        for row in db_handle.iter_rows("llm_messages", columns=["gen_id", "content"]):
+            ...
+        """
+        after = None
+        while True:
+            rows = self._fetch_page(table_name, where, columns, key, after, batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
     @db_connection
     @error_handling
     def get_column_data(self, table_name: str, column_name: str) -> list:
@@ -160,15 +618,13 @@ class DBHandler:
         概要 : カラム(列)のデータを一列文引っ張ってくるメソッド。
         table_name : 対象のテーブル
         column_name : 対象のカラム
+        全件をリストで返すので、大きいテーブルはiter_rows(table_name, columns=[column_name])を使うこと。
         """
-        
-        query = f"SELECT {column_name} FROM {table_name};"
-        
-        self.cur.execute(query)
-        data = self.cur.fetchall()
-        
-        # Extracting the column data from the tuple format
-        column_data = [item[0] for item in data]
+        query, params = self.queries.select(table_name, [column_name])
+        self.cur.execute(query, params)
+
+        # fetchallでタプルのリストを作ってから詰め替えず、カーソルから直接取り出す
+        column_data = [item[0] for item in self.cur]
 
         return column_data
     
@@ -188,6 +644,55 @@ class DBHandler:
         create_table_sql = f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_sql});"
 
         self.cur.execute(create_table_sql)
+        self.register_schema(schema, table_name)
+        self.create_indexes(schema, table_name)
+
+    @db_connection
+    @error_handling
+    def create_indexes(self, schema :dict, table_name :str = None) -> list:
+        """
+        スキーマの"indexes"と"unique"に従ってインデックスを張る。すでにあるものは飛ばす。
+        既存データに重複があってユニークインデックスが張れなかった場合は、そのインデックスだけ飛ばして続ける。
+        戻り値 : 張れなかったインデックス名のリスト
+        """
+        table_name = table_name or schema["table_name"]
+        failed = []
+        for index_name, columns, unique in index_definitions(schema, table_name):
+            unique_sql = "UNIQUE " if unique else ""
+            try:
+                self.cur.execute(
+                    f"CREATE {unique_sql}INDEX IF NOT EXISTS {index_name} ON {table_name} ({','.join(columns)});"
+                )
+            except sqlite3.IntegrityError as e:
+                print(f"{index_name}を作成できませんでした。既存データに重複があります: {e}")
+                failed.append(index_name)
+        # 張れたインデックスが変わるので、次のinsertでPRAGMAから調べ直す
+        self._unique_indexes.pop(table_name, None)
+        return failed
+
+    @db_connection
+    @error_handling
+    def migrate_table(self, schema :dict, table_name :str = None) -> list:
+        """
+        既存のDBをスキーマに追従させるメソッド。
+        テーブルが無ければ作り、スキーマにあってテーブルに無いカラムはALTER TABLEで追加し、インデックスを張る。
+        ALTER TABLEの制約上、PRIMARY KEYやUNIQUEを含むカラムは追加できないので、uniqueは"unique"で宣言すること。
+        戻り値 : 追加したカラム名のリスト
+        """
+        table_name = table_name or schema["table_name"]
+        if not self.table_exists(table_name):
+            self.create_table(schema, table_name)
+            return [col["name"] for col in schema["columns"]]
+
+        existing = set(self.get_columns(table_name))
+        added = []
+        for col in schema["columns"]:
+            if col["name"] not in existing:
+                self.cur.execute(f"ALTER TABLE {table_name} ADD COLUMN {col['name']} {col['type']};")
+                added.append(col["name"])
+        self.register_schema(schema, table_name)
+        self.create_indexes(schema, table_name)
+        return added
 
     @db_connection
     @error_handling 
@@ -220,16 +725,17 @@ class DBHandler:
 
     @db_connection
     @error_handling
-    def select_json(self, table_name: str, conditions: str = None) -> dict:
+    def select_json(self, table_name: str, conditions: dict = None) -> dict:
         """
         概要 : 指定された条件でJSONデータを取得するメソッド。
         table_name : select先のテーブルを指定。テーブルが存在していないとエラーになる。
-        conditions : select条件を指定。
+        conditions : select条件を{"id": 3}のような辞書で指定。文字列も使えるが非推奨。
         """
-        query = f"SELECT json_data FROM {table_name}"
-        if conditions:
-            query += f" WHERE {conditions}"
-        self.cur.execute(query)
+        if isinstance(conditions, str):
+            query, params = self._raw_conditions_query(self.queries.select(table_name, ["json_data"])[0], conditions)
+        else:
+            query, params = self.queries.select(table_name, ["json_data"], conditions)
+        self.cur.execute(query, params)
         result = self.cur.fetchone()
         if result:
             return json.loads(result[0])
@@ -244,17 +750,35 @@ class DBHandler:
         data: 更新したいデータ。キーにテーブルのカラム名、バリューに新しいデータを入れる。
         conditions: 更新条件を指定する辞書。キーにカラム名、バリューに条件の値を入れる。
         """
-        set_clause = ", ".join([f"{k} = ?" for k in data.keys()])
-        where_clause = " AND ".join([f"{k} = ?" for k in conditions.keys()])
-        query = f"UPDATE {table_name} SET {set_clause} WHERE {where_clause}"
-        values = list(data.values()) + list(conditions.values())
-        self.cur.execute(query, tuple(values))
+        query, where_params = self.queries.update(table_name, tuple(data.keys()), conditions)
+        self.cur.execute(query, tuple(data.values()) + where_params)
         return True
     
 
+    @db_connection
+    @error_handling
+    def fetch_all(self, query: str, params: tuple = ()) -> list:
+        """
+        概要: パラメータ付きのSELECT(WITH RECURSIVEなども可)を実行して全行を返すメソッド。
+        既存のメソッドで表せない問い合わせ用。値は必ずparamsで渡すこと。
+        """
+        self.cur.execute(query, tuple(params))
+        return self.cur.fetchall()
+
+    @db_connection
+    @error_handling
+    def execute(self, query: str, params: tuple = ()) -> int:
+        """
+        概要: パラメータ付きのDELETE/UPDATEなどを実行して、影響した行数を返すメソッド。
+        既存のメソッドで表せない更新用。値は必ずparamsで渡すこと。
+        """
+        self.cur.execute(query, tuple(params))
+        return self.cur.rowcount
+
+
 class DBHandlerAd(DBHandler):
-    def __init__(self, db_path) -> None:
-        super().__init__(db_path)
+    def __init__(self, db_path, **kwargs) -> None:
+        super().__init__(db_path, **kwargs)
 
     @db_connection
     @error_handling
@@ -1,44 +1,104 @@
 import asyncio
-from typing import Any, Dict, List, Optional
-from functools import lru_cache
+import weakref
+from typing import Any, AsyncIterator, Dict, List, Optional
 import structlog
 from pydantic import BaseModel, Field
-from supabase import create_client, Client
+# AsyncClientは2.8からの名前なので、2.5.1でも使えるAClient/AClientOptionsを使う
+from supabase import AClient, AClientOptions, acreate_client
 import json
 from contextlib import asynccontextmanager
 
+from .async_cache import AsyncTTLCache
+
 # ロガーの設定
 logger = structlog.get_logger()
 
+def _postgrest_filter(column: str, value: Any) -> str:
+    """
+    or_()の中に書くための 'column.eq."value"' 形式の条件を作る
+    """
+    if value is None:
+        return f"{column}.is.null"
+    if isinstance(value, bool):
+        return f"{column}.is.{str(value).lower()}"
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'{column}.eq."{escaped}"'
+
 class SupabaseConfig(BaseModel):
     url: str = Field(..., description="Supabase project URL")
     key: str = Field(..., description="Supabase API key")
     timeout: float = Field(10.0, description="Timeout for Supabase operations in seconds")
+    cache_ttl: float = Field(30.0, description="Seconds to keep cached query results")
+    cache_maxsize: int = Field(256, description="Maximum number of cached query results")
+    max_concurrency: int = Field(20, description="Maximum number of concurrent Supabase requests per client")
+
+class _LoopClients:
+    """1つのイベントループの中で共有するクライアント・セマフォとそのロック"""
+    def __init__(self) -> None:
+        self.lock = asyncio.Lock()
+        self.clients: Dict[tuple, AClient] = {}
+        self.semaphores: Dict[tuple, asyncio.Semaphore] = {}
+
+# 同じプロジェクトに向けたハンドラ同士で、非同期クライアント(=HTTP/2のコネクションプール)を共有する。
+# クライアントは最初に使ったイベントループに結びつくので、HTTPClientPoolと同じくループごとに持つ
+_loops: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _LoopClients]" = weakref.WeakKeyDictionary()
+
+def _loop_clients() -> _LoopClients:
+    loop = asyncio.get_running_loop()
+    shared = _loops.get(loop)
+    if shared is None:
+        shared = _loops[loop] = _LoopClients()
+    return shared
+
+async def _get_client(config: SupabaseConfig) -> AClient:
+    shared = _loop_clients()
+    key = (config.url, config.key)
+    client = shared.clients.get(key)
+    if client is None:
+        async with shared.lock:
+            client = shared.clients.get(key)
+            if client is None:
+                options = AClientOptions(postgrest_client_timeout=config.timeout)
+                client = await acreate_client(config.url, config.key, options=options)
+                shared.clients[key] = client
+    return client
+
+async def close_clients() -> None:
+    """
+    このイベントループで共有している非同期クライアントをすべて閉じる。アプリのシャットダウン時に呼ぶ
+    """
+    shared = _loops.pop(asyncio.get_running_loop(), None)
+    if shared is None:
+        return
+    for client in shared.clients.values():
+        await client.postgrest.aclose()
 
 class SupabaseHandler:
+    """
+    非同期版のSupabaseクライアントを使うので、どのメソッドもイベントループを止めない。
+    同時リクエスト数はconfig.max_concurrencyで、1回の操作の時間はconfig.timeoutで制限する。
+    """
     def __init__(self, config: SupabaseConfig):
         self.config = config
-        self.supabase: Client = create_client(config.url, config.key)
+        self.supabase: Optional[AClient] = None
+        self.cache = AsyncTTLCache(maxsize=config.cache_maxsize, ttl=config.cache_ttl)
 
     @asynccontextmanager
     async def supabase_context(self):
-        try:
-            yield self.supabase
-        except Exception as e:
-            logger.error("Supabase operation failed", error=str(e))
-            raise
-        finally:
-            # ここに必要なクリーンアップ処理を追加
-            pass
-
-    @lru_cache(maxsize=100)
-    async def _cached_query(self, table_name: str, query_hash: str):
-        async with self.supabase_context() as supabase:
-            # query_hashに基づいてクエリを構築する
-            # この例では単純化のため、全データを取得していますが、
-            # 実際にはquery_hashを解析して適切なクエリを構築する必要があります
-            result = await supabase.table(table_name).select("*").execute()
-        return result.data
+        # 別のasyncio.run()から呼ばれても前のループのクライアントを使わないよう、毎回いまのループのものを引く
+        self.supabase = await _get_client(self.config)
+        semaphores = _loop_clients().semaphores
+        key = (self.config.url, self.config.key)
+        semaphore = semaphores.get(key)
+        if semaphore is None:
+            semaphore = semaphores[key] = asyncio.Semaphore(self.config.max_concurrency)
+        async with semaphore:
+            try:
+                async with asyncio.timeout(self.config.timeout):
+                    yield self.supabase
+            except Exception as e:
+                logger.error("Supabase operation failed", error=str(e))
+                raise
 
     async def data_exists(
             self,
@@ -48,17 +108,64 @@ class SupabaseHandler:
             ) -> bool:
         """
         キャッシュを利用するので、稀に一致しない可能性があるので要注意
+        (このハンドラ経由の書き込みではキャッシュは消される)
+        条件はサーバー側で絞り込み、最大1行・1カラムだけを受け取る
         """
         check_columns = check_columns or list(data.keys())
-        query_hash = f"{table_name}:{','.join(check_columns)}:{json.dumps(data, sort_keys=True)}"
-        
+        conditions = {col: data[col] for col in check_columns}
+        key = (table_name, "exists", json.dumps(conditions, sort_keys=True, default=str))
+
+        async def load():
+            async with self.supabase_context() as supabase:
+                query = supabase.table(table_name).select(check_columns[0])
+                for column, value in conditions.items():
+                    query = query.is_(column, "null") if value is None else query.eq(column, value)
+                result = await query.limit(1).execute()
+            return bool(result.data)
+
         try:
-            cached_data = await self._cached_query(table_name, query_hash)
-            return any(all(item[col] == data[col] for col in check_columns) for item in cached_data)
+            return await self.cache.get_or_load(key, load)
         except Exception as e:
             logger.error("Error checking data existence", table=table_name, error=str(e))
             return False
 
+    async def data_exists_many(
+            self,
+            table_name: str,
+            data_list: List[Dict[str, Any]],
+            check_columns: Optional[List[str]] = None,
+            chunk_size: int = 100
+            ) -> List[bool]:
+        """
+        data_listの各行がすでに存在するかをまとめて調べ、同じ順番のboolのリストで返す。
+        1カラムならin、複数カラムならor(and(...))の条件にして、chunk_size行ごとに1リクエストで済ませる
+        """
+        if not data_list:
+            return []
+        check_columns = check_columns or list(data_list[0].keys())
+        candidates = [tuple(row[col] for col in check_columns) for row in data_list]
+        found = set()
+
+        try:
+            for start in range(0, len(candidates), chunk_size):
+                chunk = list(dict.fromkeys(candidates[start:start + chunk_size]))
+                async with self.supabase_context() as supabase:
+                    query = supabase.table(table_name).select(",".join(check_columns))
+                    if len(check_columns) == 1 and None not in (c[0] for c in chunk):
+                        query = query.in_(check_columns[0], [c[0] for c in chunk])
+                    else:
+                        query = query.or_(",".join(
+                            "and(" + ",".join(_postgrest_filter(col, value) for col, value in zip(check_columns, c)) + ")"
+                            for c in chunk
+                        ))
+                    result = await query.execute()
+                found.update(tuple(row[col] for col in check_columns) for row in result.data)
+        except Exception as e:
+            logger.error("Error checking data existence", table=table_name, error=str(e))
+            return [False] * len(data_list)
+
+        return [c in found for c in candidates]
+
     async def insert_data(
             self,
             table_name: str,
@@ -76,6 +183,7 @@ class SupabaseHandler:
         try:
             async with self.supabase_context() as supabase:
                 result = await supabase.table(table_name).insert(data).execute()
+            self.cache.invalidate(table_name)
             logger.info("Data inserted successfully", table=table_name)
             return result.data[0] if result.data else None
         except Exception as e:
@@ -102,20 +210,73 @@ class SupabaseHandler:
             logger.error("Error selecting record", table=table_name, error=str(e))
             return None
 
-    @lru_cache(maxsize=10)
     async def count_data(self, table_name: str) -> int:
-        try:
+        async def load():
             async with self.supabase_context() as supabase:
-                result = await supabase.table(table_name).select("*", count="exact").execute()
+                result = await supabase.table(table_name).select("*", count="exact", head=True).execute()
             return result.count
+
+        try:
+            return await self.cache.get_or_load((table_name, "count"), load)
         except Exception as e:
             logger.error("Error counting data", table=table_name, error=str(e))
             return 0
 
-    async def batch_insert(self, table_name: str, data_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    async def iter_rows(
+            self,
+            table_name: str,
+            where: Optional[Dict[str, Any]] = None,
+            columns: Optional[List[str]] = None,
+            batch_size: int = 1000,
+            key: str = "id"
+            ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        テーブルの行をkeyの昇順にbatch_size行ずつ取り出し、1行ずつ返す(async for で使う)。キャッシュは使わない。
+        range(offset)ではなく key > 前のページの最後 で次のページを取るので、後ろのページでも遅くならない。
+        サーバー側の最大行数(max-rows)でページが短くなることがあるので、空のページが返るまで読む。
+        途中で失敗した場合は、エクスポートが黙って欠けないよう例外をそのまま投げる
+        """
+        select = ",".join(dict.fromkeys([key, *columns])) if columns else "*"
+        after = None
+        while True:
+            try:
+                async with self.supabase_context() as supabase:
+                    query = supabase.table(table_name).select(select)
+                    for column, value in (where or {}).items():
+                        query = query.is_(column, "null") if value is None else query.eq(column, value)
+                    if after is not None:
+                        query = query.gt(key, after)
+                    result = await query.order(key).limit(batch_size).execute()
+            except Exception as e:
+                logger.error("Error iterating rows", table=table_name, after=after, error=str(e))
+                raise
+            rows = result.data
+            if not rows:
+                return
+            after = rows[-1][key]
+            for row in rows:
+                if columns and key not in columns:
+                    row = {k: v for k, v in row.items() if k != key}
+                yield row
+
+    async def batch_insert(
+            self,
+            table_name: str,
+            data_list: List[Dict[str, Any]],
+            check_columns: Optional[List[str]] = None
+            ) -> List[Dict[str, Any]]:
+        """
+        check_columnsを指定すると、data_exists_manyで既存の行を1回の問い合わせでまとめて除いてから挿入する
+        """
         try:
+            if check_columns:
+                exists = await self.data_exists_many(table_name, data_list, check_columns)
+                data_list = [row for row, e in zip(data_list, exists) if not e]
+                if not data_list:
+                    return []
             async with self.supabase_context() as supabase:
                 result = await supabase.table(table_name).insert(data_list).execute()
+            self.cache.invalidate(table_name)
             logger.info("Batch insert completed", table=table_name, count=len(data_list))
             return result.data
         except Exception as e:
@@ -134,6 +295,7 @@ class SupabaseHandler:
                 for key, value in conditions.items():
                     query = query.eq(key, value)
                 result = await query.execute()
+            self.cache.invalidate(table_name)
             logger.info("Data updated successfully", table=table_name)
             return result.data[0] if result.data else None
         except Exception as e:
@@ -151,12 +313,26 @@ class SupabaseHandler:
                 for key, value in conditions.items():
                     query = query.eq(key, value)
                 await query.execute()
+            self.cache.invalidate(table_name)
             logger.info("Record deleted successfully", table=table_name)
             return True
         except Exception as e:
             logger.error("Error deleting record", table=table_name, error=str(e))
             return False
 
+    async def load_history(self, branch_id: int) -> List[Dict[str, str]]:
+        """
+        ブランチの履歴をLLMに渡すmessagesの形で返す。
+        config/sql/load_history.sqlの関数(再帰CTE)をRPCで呼ぶので、1回の往復で済む
+        """
+        try:
+            async with self.supabase_context() as supabase:
+                result = await supabase.rpc("load_history", {"p_branch_id": branch_id}).execute()
+            return [{"role": row["role"], "content": row["content"]} for row in result.data]
+        except Exception as e:
+            logger.error("Error loading history", branch_id=branch_id, error=str(e))
+            return []
+
 # 使用例
 async def main():
     config = SupabaseConfig(url="YOUR_SUPABASE_URL", key="YOUR_SUPABASE_KEY")
@@ -0,0 +1,83 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import structlog
+
+logger = structlog.get_logger()
+
+
+class AsyncTTLCache:
+    """
+    コルーチンの結果を覚えておくTTL+LRUキャッシュ。
+
+    functools.lru_cacheをasync defに付けるとコルーチンオブジェクトそのものがキャッシュされてしまい、
+    2回目のawaitで失敗するので、結果の値を保存するこちらを使う。
+    同じキーの読み込みが同時に走った場合は、最初の1回の結果を全員で待つ(重複リクエストをまとめる)。
+    キーはタプルで、先頭の要素をテーブル名にしておくとinvalidate(table_name)でまとめて消せる。
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: float = 30.0) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._generation = 0
+
+    def _get_fresh(self, key: Hashable) -> Tuple[bool, Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def _put(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        hit, value = self._get_fresh(key)
+        if hit:
+            return value
+
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            # 読み込みは呼び出し元とは別のタスクで走らせる。
+            # 最初の呼び出し元がキャンセルされても、同じキーを待っているほかの呼び出し元は巻き込まれない
+            inflight = asyncio.ensure_future(loader())
+            self._inflight[key] = inflight
+            inflight.add_done_callback(functools.partial(self._loaded, key, self._generation))
+        return await asyncio.shield(inflight)
+
+    def _loaded(self, key: Hashable, generation: int, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        # 待っている人がいなくても"exception was never retrieved"が出ないよう、ここで例外を受け取っておく
+        if future.cancelled() or future.exception() is not None:
+            return
+        # 読み込み中にinvalidateされた場合、古いかもしれない結果は保存しない
+        if generation == self._generation:
+            self._put(key, future.result())
+
+    def invalidate(self, table_name: Optional[str] = None) -> None:
+        """
+        table_nameを指定するとそのテーブルのキーだけ、指定しなければ全部を消す。
+        """
+        self._generation += 1
+        # 書き込み前に始まった読み込みに後から合流しないよう、実行中のものも外して次は読み直させる
+        if table_name is None:
+            self._data.clear()
+            self._inflight.clear()
+            return
+        for store in (self._data, self._inflight):
+            for key in [k for k in store if isinstance(k, tuple) and k and k[0] == table_name]:
+                del store[key]
+        logger.debug("Cache invalidated", table=table_name)
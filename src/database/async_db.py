@@ -0,0 +1,131 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+from .DB_utils import DBHandler, load_db_profile
+
+
+def _reader(name: str):
+    method = getattr(DBHandler, name)
+
+    @functools.wraps(method)
+    async def wrapper(self: "AsyncDBHandler", *args, **kwargs):
+        return await self._run(self._read_executor, getattr(self.reader, name), *args, **kwargs)
+    return wrapper
+
+
+def _writer(name: str):
+    method = getattr(DBHandler, name)
+
+    @functools.wraps(method)
+    async def wrapper(self: "AsyncDBHandler", *args, **kwargs):
+        return await self._run(self._write_executor, getattr(self.writer, name), *args, **kwargs)
+    return wrapper
+
+
+class AsyncDBHandler:
+    """
+    DBHandlerと同じメソッドをawaitで呼べるようにしたもの。FastAPI/WebSocketのハンドラから使う。
+
+    sqlite3は同期APIなので、直接呼ぶとディスク書き込みのたびにイベントループが止まる。
+    書き込みは専用のスレッド1本に集めて順番に実行し(SQLiteの書き込みはどうせ1つずつ)、
+    読み込みは複数のスレッドで並列に行う。各スレッドは自分のコネクションを使い回す(=コネクションプール)。
+    WALモードにするので、読み込みは書き込みの完了を待たない。
+
+    db = AsyncDBHandler("data/app.db")
+    await db.insert_data("user_messages", {"user_id": 1, "content": "..."})
+    row = await db.select_one_record("user_messages", {"id": 1})
+    await db.close()
+    """
+
+    def __init__(self, db_path, readers: int = 4, schemas: dict = None, profile=None) -> None:
+        """
+        db_path : 接続先のSQLiteファイル。
+        readers : 読み込み用のスレッド(コネクション)の数。
+        schemas : load_schemasで読み込んだスキーマ。uniqueキーを使った重複チェックに使う。
+        profile : PRAGMAのプロファイル名か辞書(DBHandlerと同じ)。Noneならsqlite3の既定のまま。
+                  settings.yamlで選んだものを使うならload_db_profile()を渡す。どの場合もjournal_modeはWALにする。
+        """
+        self.db_path = db_path
+        if isinstance(profile, str):
+            profile = load_db_profile(profile)
+        profile = {**(profile or {}), "journal_mode": "WAL"}
+        self.writer = DBHandler(db_path, persistent=True, schemas=schemas, profile=profile)
+        self.reader = DBHandler(db_path, persistent=True, schemas=schemas, profile=profile)
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-reader")
+
+    async def _run(self, executor: ThreadPoolExecutor, func: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+    async def run_write(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        func(writer, *args, **kwargs) を書き込みスレッドで1つのトランザクションとして実行する。
+        複数のメソッド呼び出しを1回のcommitにまとめたいとき(DBHandler.transactionの代わり)に使う。
+        """
+        def job():
+            with self.writer.transaction():
+                return func(self.writer, *args, **kwargs)
+        return await self._run(self._write_executor, job)
+
+    async def run_read(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        func(reader, *args, **kwargs) を読み込みスレッドで実行する。
+        """
+        return await self._run(self._read_executor, func, self.reader, *args, **kwargs)
+
+    async def iter_rows(self, table_name, where: dict = None, columns=None, batch_size: int = 1000, key: str = "id"):
+        """
+        DBHandler.iter_rowsの非同期版(async for で使う)。1ページずつ読み込みスレッドで取り出す。
+        途中で失敗した場合は例外を投げる。
+        """
+        after = None
+        while True:
+            rows = await self._run(
+                self._read_executor, self.reader._fetch_page, table_name, where, columns, key, after, batch_size
+            )
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    async def close(self) -> None:
+        """
+        実行中の処理が終わるのを待ってから、スレッドとコネクションを閉じる。
+        """
+        await asyncio.to_thread(self._write_executor.shutdown, True)
+        await asyncio.to_thread(self._read_executor.shutdown, True)
+        self.writer.close()
+        self.reader.close()
+
+    async def __aenter__(self) -> "AsyncDBHandler":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    # 読み込み系
+    data_exists = _reader("data_exists")
+    select_one_record = _reader("select_one_record")
+    select_json = _reader("select_json")
+    count_data = _reader("count_data")
+    get_columns = _reader("get_columns")
+    get_column_data = _reader("get_column_data")
+    table_exists = _reader("table_exists")
+    fetch_all = _reader("fetch_all")
+
+    # 書き込み系
+    insert_data = _writer("insert_data")
+    insert_many = _writer("insert_many")
+    upsert_data = _writer("upsert_data")
+    insert_json = _writer("insert_json")
+    update_data = _writer("update_data")
+    execute = _writer("execute")
+    create_table = _writer("create_table")
+    create_indexes = _writer("create_indexes")
+    migrate_table = _writer("migrate_table")
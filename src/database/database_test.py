@@ -1,4 +1,5 @@
 import os
+import time
 from supabase import create_client, Client
 
 url: str = os.environ.get("SUPABASE_URL")
@@ -6,6 +7,31 @@ key: str = os.environ.get("SUPABASE_API_KEY")
 password: str = os.environ.get("SUPABASE_PASSWORD")
 supabase: Client = create_client(url, key)
 
+# LINE_IDごとのUSERの行を少しの間だけ覚えておくキャッシュ
+# このモジュール経由で更新した場合は、更新後の行で上書きされる
+USER_CACHE_TTL = 60.0
+_user_cache: dict = {}
+
+
+def _remember_user(line_id: str, row: dict) -> None:
+    cached = _user_cache.get(line_id, (0, {}))[1]
+    _user_cache[line_id] = (time.monotonic() + USER_CACHE_TTL, {**cached, **row})
+
+
+def _cached_user_value(line_id: str, column: str):
+    entry = _user_cache.get(line_id)
+    if entry is None or entry[0] < time.monotonic() or column not in entry[1]:
+        return None
+    return entry[1][column]
+
+
+# LINE_IDで絞り込んでUSERを更新し、更新後の行を返す。ユーザーが存在しなければdataは空になる
+def _update_user(line_id: str, values: dict):
+    response = supabase.table("USER").update(values).eq("LINE_ID", line_id).execute()
+    if response.data:
+        _remember_user(line_id, response.data[0])
+    return response
+
 
 # USERテーブルのデータを全て取得する
 async def get_user():
@@ -21,11 +47,14 @@ async def get_ps_log():
 # アカウントを登録する 同じLINE_IDが存在する場合は登録しない
 async def create_user(line_id: str, line_name: str) -> tuple|str:
     try:
-        data, count = (
+        response = (
             supabase.table("USER")
             .insert({"LINE_ID": line_id, "LINE_NAME": line_name})
             .execute()
         )
+        if response.data:
+            _remember_user(line_id, response.data[0])
+        data, count = response
         return data, count
     except:
         return "user_already_exist"
@@ -35,67 +64,47 @@ async def create_user(line_id: str, line_name: str) -> tuple|str:
 # 志望理由書採点準備
 # 引数で与えられたLINE_IDが存在すれば、そのIDのURL_STATE	SCORING_STATE	SCORING_MODEをそれぞれURL待機中	採点準備中	志望理由書にする
 async def prepare_ps_scoring(line_id: str):
-    user = await get_user()
-    for i in user:
-        if i["LINE_ID"] == line_id:
-            data, count = (
-                supabase.table("USER")
-                .update(
-                    {
-                        "URL_STATE": "URL待機中",
-                        "SCORING_STATE": "採点準備中",
-                        "SCORING_MODE": "志望理由書",
-                    }
-                )
-                .eq("LINE_ID", line_id)
-                .execute()
-            )
-            return data, count
-    return "User not found"
+    response = _update_user(
+        line_id,
+        {
+            "URL_STATE": "URL待機中",
+            "SCORING_STATE": "採点準備中",
+            "SCORING_MODE": "志望理由書",
+        },
+    )
+    if not response.data:
+        return "User not found"
+    data, count = response
+    return data, count
 
 
 # 志望理由書URL登録
 # 引数で与えられたLINE_IDがUSERに存在すれば、PersonalStatementScoringLogで新しい行を作成し、LINE_IDとDOCS_URLを登録する
 # また、USERのURL_STATEをURL登録済みに、SCORING_STATEを採点待機中にする
+# USERの更新を先に行い、更新できた(=ユーザーが存在した)場合だけログを作る
 async def register_ps_url(line_id: str, docs_url: str):
-    user = await get_user()
-    for i in user:
-        if i["LINE_ID"] == line_id:
-            data, count = (
-                supabase.table("PersonalStatementScoringLog")
-                .insert({"LINE_ID": line_id, "DOCS_URL": docs_url})
-                .execute()
-            )
-            data, count = (
-                supabase.table("USER")
-                .update({"URL_STATE": "URL登録済み", "SCORING_STATE": "採点待機中"})
-                .eq("LINE_ID", line_id)
-                .execute()
-            )
-            return data, count
-    return "User not found"
+    response = _update_user(line_id, {"URL_STATE": "URL登録済み", "SCORING_STATE": "採点待機中"})
+    if not response.data:
+        return "User not found"
+    supabase.table("PersonalStatementScoringLog").insert(
+        {"LINE_ID": line_id, "DOCS_URL": docs_url}
+    ).execute()
+    data, count = response
+    return data, count
 
 
 # 志望理由書の採点を開始する
 # 引数で与えられたLINE_IDがUSERに存在すれば、PersonalStatementScoringLogで新しい行を作成し、LINE_IDとDOCS_URLを登録する
 # また、USERのURL_STATEをURL登録済みに、SCORING_STATEを採点中にする
 async def start_ps_scoring(line_id: str, docs_url: str):
-    user = await get_user()
-    for i in user:
-        if i["LINE_ID"] == line_id:
-            data, count = (
-                supabase.table("PersonalStatementScoringLog")
-                .insert({"LINE_ID": line_id, "DOCS_URL": docs_url})
-                .execute()
-            )
-            data, count = (
-                supabase.table("USER")
-                .update({"URL_STATE": "URL登録済み", "SCORING_STATE": "採点中"})
-                .eq("LINE_ID", line_id)
-                .execute()
-            )
-            return data, count
-    return "User not found"
+    response = _update_user(line_id, {"URL_STATE": "URL登録済み", "SCORING_STATE": "採点中"})
+    if not response.data:
+        return "User not found"
+    supabase.table("PersonalStatementScoringLog").insert(
+        {"LINE_ID": line_id, "DOCS_URL": docs_url}
+    ).execute()
+    data, count = response
+    return data, count
 
 
 # 志望理由書の採点を記録する
@@ -170,41 +179,34 @@ async def record_es_scoring(
     return data, count
 
 async def set_user_state(user_id: str, state: str):
-    data, count = (
-        supabase.table("USER")
-        .update({"SCORING_STATE": state})
-        .eq("LINE_ID", user_id)
-        .execute()
-    )
+    data, count = _update_user(user_id, {"SCORING_STATE": state})
     return data, count
 
 async def get_user_state(user_id: str) -> str:
+    cached = _cached_user_value(user_id, "SCORING_STATE")
+    if cached is not None:
+        return cached
     response = supabase.table("USER").select("SCORING_STATE").eq("LINE_ID", user_id).execute()
     if response.data:
+        _remember_user(user_id, response.data[0])
         return response.data[0]["SCORING_STATE"]
     return None
 
 async def clear_user_state(user_id: str):
-    data, count = (
-        supabase.table("USER")
-        .update({"SCORING_STATE": None, "SCORING_MODE": None})
-        .eq("LINE_ID", user_id)
-        .execute()
-    )
+    data, count = _update_user(user_id, {"SCORING_STATE": None, "SCORING_MODE": None})
     return data, count
 
 async def save_essay_question(user_id: str, question: str):
-    data, count = (
-        supabase.table("USER")
-        .update({"ESSAY_QUESTION": question})
-        .eq("LINE_ID", user_id)
-        .execute()
-    )
+    data, count = _update_user(user_id, {"ESSAY_QUESTION": question})
     return data, count
 
 async def get_essay_question(user_id: str) -> str:
+    cached = _cached_user_value(user_id, "ESSAY_QUESTION")
+    if cached is not None:
+        return cached
     response = supabase.table("USER").select("ESSAY_QUESTION").eq("LINE_ID", user_id).execute()
     if response.data:
+        _remember_user(user_id, response.data[0])
         return response.data[0]["ESSAY_QUESTION"]
     return None
 
@@ -0,0 +1,255 @@
+'''
+目次
+MessageTree
+    migrate                 :ツリーに必要なテーブル(message_nodes, branches, 各メッセージテーブル)を用意する
+    create_branch           :新しいブランチを作る。system_messageを渡すとそれがルートになる
+    append                  :保存済みのメッセージをブランチの先頭につなげる(O(1))
+    append_message          :メッセージの保存とappendを1つのトランザクションで行う
+    fork                    :任意のメッセージから新しいブランチを生やす
+    get_head                :ブランチの先頭のノードidを返す
+    ancestors               :ルートから指定したノードまでのノードを順に返す
+    children                :指定したノードの子ノードを返す
+    load_history            :ブランチの履歴をLLMに渡すmessagesの形で組み立てる(先頭ノードごとにLRUキャッシュ)
+
+メッセージは役割ごとのテーブル(system_messages, user_messages, llm_messages)に保存し、
+message_nodesが parent_id で木構造を、branchesが head_id で各ブランチの先頭を指す。
+1ターン追加するごとに書き込むのはノード1行とbranchesの1行だけなので、会話が長くなってもコストは変わらない。
+'''
+
+
+from collections import OrderedDict
+import threading
+
+from .DB_utils import DBHandler, load_schemas
+
+# roleと、その本文が入っているテーブルの対応
+ROLE_TABLES = {
+    "system": "system_messages",
+    "user": "user_messages",
+    "assistant": "llm_messages",
+}
+
+ANCESTORS_SQL = """
+WITH RECURSIVE chain(id, parent_id, role, message_id, depth) AS (
+    SELECT id, parent_id, role, message_id, depth FROM message_nodes WHERE id = ?
+    UNION ALL
+    SELECT n.id, n.parent_id, n.role, n.message_id, n.depth
+    FROM message_nodes n JOIN chain c ON n.id = c.parent_id
+)
+SELECT id, parent_id, role, message_id, depth FROM chain ORDER BY depth;
+"""
+
+# 指定したノード(ブランチの先頭)からルートまでたどり、本文も一緒に引いてくる
+HISTORY_SQL = """
+WITH RECURSIVE chain(id, parent_id, role, message_id, depth) AS (
+    SELECT id, parent_id, role, message_id, depth FROM message_nodes
+    WHERE id = ?
+    UNION ALL
+    SELECT n.id, n.parent_id, n.role, n.message_id, n.depth
+    FROM message_nodes n JOIN chain c ON n.id = c.parent_id
+)
+SELECT c.id, c.role, COALESCE(s.content, u.content, l.content)
+FROM chain c
+LEFT JOIN system_messages s ON c.role = 'system' AND s.id = c.message_id
+LEFT JOIN user_messages u ON c.role = 'user' AND u.id = c.message_id
+LEFT JOIN llm_messages l ON c.role = 'assistant' AND l.id = c.message_id
+ORDER BY c.depth;
+"""
+
+
+def estimate_tokens(text :str) -> int:
+    """
+    トークン数のざっくりした見積もり。ASCIIは4文字で1トークン、それ以外(日本語など)は1文字1トークンとみなす。
+    """
+    if not text:
+        return 0
+    ascii_count = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_count) + (ascii_count + 3) // 4
+
+
+def split_messages(messages :list, max_tokens :int, counts :list) -> tuple:
+    """
+    countsの合計がmax_tokens以下になるまで、system以外の古いメッセージから落とす。最後のメッセージは必ず残す。
+    counts : messagesと同じ順番の、各メッセージのトークン数。
+    戻り値 : (残したメッセージのリスト, 落としたメッセージのリスト, 残した分のトークン数)
+    """
+    total = sum(counts)
+    keep = [True] * len(messages)
+    for i, message in enumerate(messages[:-1]):
+        if total <= max_tokens:
+            break
+        if message.get("role") == "system":
+            continue
+        keep[i] = False
+        total -= counts[i]
+    kept = [m for m, k in zip(messages, keep) if k]
+    dropped = [m for m, k in zip(messages, keep) if not k]
+    return kept, dropped, total
+
+
+def trim_messages(messages :list, max_tokens :int, token_counter=estimate_tokens) -> list:
+    """
+    messagesの合計トークン数がmax_tokens以下になるまで、system以外の古いメッセージから落とす。
+    最後のメッセージは必ず残す。
+    """
+    counts = [token_counter(m["content"]) for m in messages]
+    return split_messages(messages, max_tokens, counts)[0]
+
+
+class HistoryCache:
+    """
+    ノードid -> そのノードまでの履歴(タプル) を持つLRUキャッシュ。
+    ノードは追記のみで書き換えないので、同じノードidの履歴は変わらない。
+    """
+    def __init__(self, maxsize :int = 256) -> None:
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, node_id :int):
+        with self._lock:
+            prefix = self._data.get(node_id)
+            if prefix is not None:
+                self._data.move_to_end(node_id)
+            return prefix
+
+    def put(self, node_id :int, prefix :tuple) -> None:
+        with self._lock:
+            self._data[node_id] = prefix
+            self._data.move_to_end(node_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class MessageTree:
+    def __init__(self, db_handle :DBHandler, cache_size :int = 256) -> None:
+        """
+        db_handle : 保存先のDBHandler。persistentモードにしておくと1ターンあたりの接続コストが減る。
+        cache_size : load_historyで組み立てた履歴を何ブランチ分(先頭ノード単位)覚えておくか。
+        """
+        self.db_handle = db_handle
+        self.history_cache = HistoryCache(cache_size)
+
+    def migrate(self, schema_dir :str = "config/db_schema") -> None:
+        """
+        ツリーで使うテーブルを作る。既存のDBにはhead_idカラムやインデックスを追加する。
+        """
+        schemas = load_schemas(schema_dir)
+        for table_name in ["message_nodes", "branches", *ROLE_TABLES.values()]:
+            self.db_handle.migrate_table(schemas[table_name])
+
+    def create_branch(self, user_id :int, system_message :str = None) -> int:
+        """
+        新しいブランチを作り、そのidを返す。
+        system_message : 渡した場合はsystem_messagesに保存し、ブランチのルートにする。
+        """
+        with self.db_handle.transaction():
+            branch_id = self.db_handle.insert_data(
+                "branches", {"user_id": user_id, "head_id": None}, hard=True, last_id=True
+                )
+            if system_message is not None:
+                self.append_message(branch_id, "system", {"user_id": user_id, "content": system_message})
+        return branch_id
+
+    def get_head(self, branch_id :int) -> int:
+        """
+        ブランチの先頭のノードidを返す。まだ何もつながっていなければNone。
+        """
+        rows = self.db_handle.fetch_all("SELECT head_id FROM branches WHERE id = ?", (branch_id,))
+        if not rows:
+            raise KeyError(f"branch {branch_id} が存在しません")
+        return rows[0][0]
+
+    def append(self, branch_id :int, role :str, message_id :int, user_id :int = None) -> int:
+        """
+        保存済みのメッセージ(role別テーブルのid)をブランチの先頭の子としてつなぎ、先頭をそのノードに進める。
+        戻り値 : 追加したノードのid
+        """
+        if role not in ROLE_TABLES:
+            raise ValueError(f"未知のroleです: {role}")
+        with self.db_handle.transaction():
+            head_id = self.get_head(branch_id)
+            depth = 0
+            if head_id is not None:
+                depth = self.db_handle.fetch_all(
+                    "SELECT depth FROM message_nodes WHERE id = ?", (head_id,)
+                    )[0][0] + 1
+            node_id = self.db_handle.insert_data(
+                "message_nodes",
+                {"parent_id": head_id, "user_id": user_id, "role": role, "message_id": message_id, "depth": depth},
+                hard=True,
+                last_id=True
+                )
+            self.db_handle.update_data("branches", {"head_id": node_id}, {"id": branch_id})
+        return node_id
+
+    def append_message(self, branch_id :int, role :str, data :dict) -> int:
+        """
+        メッセージをroleに対応するテーブルに保存し、ブランチにつなげる。
+        data : 保存したいレコード。user_idとcontentは必須。assistantならgen_idなどのメタデータも入れられる。
+        戻り値 : 追加したノードのid
+        """
+        with self.db_handle.transaction():
+            parent_id = self.get_head(branch_id)
+            message_id = self.db_handle.insert_data(ROLE_TABLES[role], data, hard=True, last_id=True)
+            node_id = self.append(branch_id, role, message_id, data.get("user_id"))
+
+        # 親の履歴がキャッシュにあれば、DBを読み直さずに続きを足しておく
+        # 外側のtransactionがまだ続いている(rollbackされうる)間はキャッシュしない
+        if self.db_handle.conn is not None:
+            return node_id
+        prefix = self.history_cache.get(parent_id) if parent_id is not None else ()
+        if prefix is not None:
+            self.history_cache.put(node_id, prefix + ({"role": role, "content": data.get("content")},))
+        return node_id
+
+    def fork(self, node_id :int, user_id :int) -> int:
+        """
+        node_idを先頭とする新しいブランチを作る。元のブランチはそのまま残る。
+        戻り値 : 新しいブランチのid
+        """
+        return self.db_handle.insert_data(
+            "branches", {"user_id": user_id, "head_id": node_id}, hard=True, last_id=True
+            )
+
+    def ancestors(self, node_id :int) -> list:
+        """
+        ルートからnode_idまでのノードを (id, parent_id, role, message_id, depth) のリストで返す。
+        主キーをたどる再帰CTEなので、1回の問い合わせで済む。
+        """
+        return self.db_handle.fetch_all(ANCESTORS_SQL, (node_id,)) or []
+
+    def children(self, node_id :int) -> list:
+        """
+        node_idから分岐している子ノードを (id, role, message_id) のリストで返す。
+        """
+        return self.db_handle.fetch_all(
+            "SELECT id, role, message_id FROM message_nodes WHERE parent_id = ? ORDER BY id", (node_id,)
+            ) or []
+
+    def load_history(self, branch_id :int, max_tokens :int = None, token_counter=estimate_tokens) -> list:
+        """
+        ブランチの履歴を [{"role": ..., "content": ...}, ...] の形で返す。LLMClient.post_chat_completionにそのまま渡せる。
+        先頭ノードの履歴がキャッシュにあればDBには先頭ノードidを聞くだけ。無ければ再帰CTEの1回の問い合わせで組み立てる。
+        max_tokens : 指定すると、合計がこのトークン数に収まるよう古いメッセージから落とす(systemは残す)。
+        token_counter : テキストのトークン数を返す関数。ContextWindow.counter.count_textを渡すとモデルに合った数え方になる。
+        """
+        head_id = self.get_head(branch_id)
+        if head_id is None:
+            return []
+
+        prefix = self.history_cache.get(head_id)
+        if prefix is None:
+            # branch_idから引き直すと、その間に先頭が進んだとき別の履歴をhead_idでキャッシュしてしまう
+            rows = self.db_handle.fetch_all(HISTORY_SQL, (head_id,)) or []
+            prefix = tuple({"role": role, "content": content} for _, role, content in rows)
+            self.history_cache.put(head_id, prefix)
+
+        messages = [dict(message) for message in prefix]
+        if max_tokens is not None:
+            messages = trim_messages(messages, max_tokens, token_counter)
+        return messages
@@ -0,0 +1,199 @@
+'''
+目次
+QueryBuilder
+    insert                  :INSERT文(ON CONFLICT DO NOTHING / RETURNING付きも)を組み立てる
+    upsert                  :INSERT ... ON CONFLICT DO UPDATE文を組み立てる
+    select                  :SELECT文を組み立てる。条件はwhereで作る
+    exists                  :条件に合う行があるかを確かめるSELECT 1 ... LIMIT 1を組み立てる
+    count                   :SELECT COUNT(*)を組み立てる
+    page                    :キー(id)の順に1ページ分を取り出すSELECT文を組み立てる(キーセットページング)
+    update                  :UPDATE文を組み立てる
+    where                   :条件の辞書からWHERE句とパラメータを作る
+    validate                :テーブル名・カラム名をスキーマと照合する
+'''
+
+
+import re, threading
+from collections import OrderedDict
+
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class QueryBuilder:
+    """
+    パラメータ付きのSQLを組み立てるクラス。値はすべて?で渡し、SQL文には識別子しか埋め込まない。
+    組み立てたSQL文は (種類, テーブル, カラムの組) ごとにキャッシュするので、同じ形の呼び出しでは文字列を作り直さない。
+    識別子の検査もキャッシュに無いときだけ行う。
+    スキーマが登録されているテーブルはカラム名をスキーマと照合し、無いテーブルは識別子の形式だけ検査する。
+    """
+    def __init__(self, schemas :dict = None, cache_size :int = 1024) -> None:
+        """
+        schemas : テーブル名 -> スキーマ の辞書。DBHandler.schemasをそのまま渡せば登録が共有される。
+        cache_size : 覚えておくSQL文の数。
+        """
+        self.schemas = schemas if schemas is not None else {}
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _statement(self, key :tuple, build) -> str:
+        with self._lock:
+            sql = self._cache.get(key)
+            if sql is not None:
+                self._cache.move_to_end(key)
+                return sql
+        sql = build()
+        with self._lock:
+            self._cache[key] = sql
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return sql
+
+    def validate(self, table_name :str, columns=()) -> None:
+        """
+        テーブル名とカラム名が識別子として正しく、スキーマがあればそこに含まれているかを確かめる。
+        不正な場合はValueErrorを投げる。
+        """
+        if not _IDENTIFIER.match(table_name or ""):
+            raise ValueError(f"Invalid table name: {table_name!r}")
+        schema = self.schemas.get(table_name)
+        known = {col["name"] for col in schema["columns"]} if schema else None
+        for column in columns:
+            if not _IDENTIFIER.match(column or ""):
+                raise ValueError(f"Invalid column name: {column!r}")
+            if known is not None and column not in known:
+                raise ValueError(f"Unknown column {column!r} for table {table_name}")
+
+    def insert(self, table_name :str, columns :tuple, conflict_key :tuple = None, returning :bool = False) -> str:
+        """
+        INSERT文を返す。conflict_keyを渡すとON CONFLICT DO NOTHING、returningでRETURNING rowidが付く。
+        """
+        columns, conflict_key = tuple(columns), tuple(conflict_key or ())
+        def build():
+            self.validate(table_name, columns + conflict_key)
+            sql = f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({','.join(['?'] * len(columns))})"
+            if conflict_key:
+                sql += f" ON CONFLICT ({','.join(conflict_key)}) DO NOTHING"
+            if returning:
+                sql += " RETURNING rowid"
+            return sql + ";"
+        return self._statement(("insert", table_name, columns, conflict_key, returning), build)
+
+    def upsert(self, table_name :str, columns :tuple, conflict_key :tuple, update_columns :tuple) -> str:
+        """
+        INSERT ... ON CONFLICT DO UPDATE ... RETURNING rowid を返す。update_columnsが空ならDO NOTHING。
+        """
+        columns, conflict_key, update_columns = tuple(columns), tuple(conflict_key), tuple(update_columns)
+        def build():
+            self.validate(table_name, columns + conflict_key + update_columns)
+            sql = (f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({','.join(['?'] * len(columns))})"
+                   f" ON CONFLICT ({','.join(conflict_key)})")
+            if update_columns:
+                sql += " DO UPDATE SET " + ", ".join([f"{k} = excluded.{k}" for k in update_columns])
+            else:
+                sql += " DO NOTHING"
+            return sql + " RETURNING rowid;"
+        return self._statement(("upsert", table_name, columns, conflict_key, update_columns), build)
+
+    def where(self, table_name :str, conditions :dict) -> tuple:
+        """
+        {"col": 値} の辞書から (WHERE句, パラメータのタプル) を返す。条件はANDでつなぐ。
+        値がNoneならIS NULL、リストかタプルならIN (...)になる。conditionsが空ならWHERE句は""。
+        """
+        if not conditions:
+            return "", ()
+        shape, params = [], []
+        for column, value in conditions.items():
+            if value is None:
+                shape.append((column, "null", 0))
+            elif isinstance(value, (list, tuple)):
+                shape.append((column, "in", len(value)))
+                params.extend(value)
+            else:
+                shape.append((column, "eq", 0))
+                params.append(value)
+        shape = tuple(shape)
+        def build():
+            self.validate(table_name, [column for column, _, _ in shape])
+            parts = []
+            for column, op, size in shape:
+                if op == "null":
+                    parts.append(f"{column} IS NULL")
+                elif op == "in":
+                    # 空のINはSQLiteでは偽になる
+                    parts.append(f"{column} IN ({','.join(['?'] * size)})")
+                else:
+                    parts.append(f"{column} = ?")
+            return " WHERE " + " AND ".join(parts)
+        return self._statement(("where", table_name, shape), build), tuple(params)
+
+    def select(self, table_name :str, fields=None, conditions :dict = None, limit :int = None) -> tuple:
+        """
+        SELECT文とパラメータを返す。fieldsはカラム名のリストか"a, b"の文字列。省略すると*。
+        """
+        if isinstance(fields, str):
+            fields = [field.strip() for field in fields.split(",")]
+        fields = tuple(fields or ("*",))
+        where, params = self.where(table_name, conditions)
+        def build():
+            self.validate(table_name, [field for field in fields if field != "*"])
+            sql = f"SELECT {','.join(fields)} FROM {table_name}{where}"
+            if limit is not None:
+                sql += f" LIMIT {int(limit)}"
+            return sql + ";"
+        return self._statement(("select", table_name, fields, where, limit), build), params
+
+    def page(self, table_name :str, fields=None, conditions :dict = None, key :str = "id", after=None, limit :int = 1000) -> tuple:
+        """
+        key の昇順に、after より大きいものを最大limit行取り出すSQLとパラメータを返す。最初のページはafter=None。
+        OFFSETと違って読み飛ばす行が無いので、何ページ目でも1回の問い合わせはインデックスの範囲検索で済む。
+        取り出す行の先頭には次のページの起点にするためのkeyが付く。
+        """
+        if isinstance(fields, str):
+            fields = [field.strip() for field in fields.split(",")]
+        fields = tuple(fields or ("*",))
+        where, params = self.where(table_name, conditions)
+        has_after = after is not None
+        def build():
+            self.validate(table_name, [field for field in fields if field != "*"] + [key])
+            sql = f"SELECT {key},{','.join(fields)} FROM {table_name}{where}"
+            if has_after:
+                sql += (" AND " if where else " WHERE ") + f"{key} > ?"
+            return sql + f" ORDER BY {key} LIMIT ?;"
+        sql = self._statement(("page", table_name, fields, where, key, has_after), build)
+        return sql, params + ((after,) if has_after else ()) + (int(limit),)
+
+    def exists(self, table_name :str, conditions :dict) -> tuple:
+        """
+        条件に合う行が1行でもあるかを確かめるSQLとパラメータを返す。
+        """
+        where, params = self.where(table_name, conditions)
+        def build():
+            self.validate(table_name)
+            return f"SELECT 1 FROM {table_name}{where} LIMIT 1;"
+        return self._statement(("exists", table_name, where), build), params
+
+    def count(self, table_name :str, conditions :dict = None) -> tuple:
+        """
+        SELECT COUNT(*)のSQLとパラメータを返す。
+        """
+        where, params = self.where(table_name, conditions)
+        def build():
+            self.validate(table_name)
+            return f"SELECT COUNT(*) FROM {table_name}{where};"
+        return self._statement(("count", table_name, where), build), params
+
+    def update(self, table_name :str, columns :tuple, conditions :dict) -> tuple:
+        """
+        UPDATE文とWHEREのパラメータを返す。実行するときはSETの値のうしろにWHEREのパラメータを続ける。
+        全行の書き換えを防ぐため、conditionsが空ならValueErrorを投げる。
+        """
+        if not conditions:
+            raise ValueError("UPDATE without conditions is not allowed")
+        columns = tuple(columns)
+        where, where_params = self.where(table_name, conditions)
+        def build():
+            self.validate(table_name, columns)
+            return f"UPDATE {table_name} SET {', '.join([f'{k} = ?' for k in columns])}{where};"
+        return self._statement(("update", table_name, columns, where), build), where_params
@@ -0,0 +1,212 @@
+import asyncio
+import inspect
+from itertools import groupby
+from typing import Any, Callable, Dict, List, Optional
+
+import structlog
+
+from .async_db import AsyncDBHandler
+from .DB_utils import DBHandler
+
+logger = structlog.get_logger()
+
+_STOP = object()
+
+
+class _Call:
+    """キューに積まれた任意の書き込み処理"""
+
+    __slots__ = ("func", "args", "kwargs")
+
+    def __init__(self, func: Callable, args: tuple, kwargs: dict) -> None:
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+
+class WriteBehindQueue:
+    """
+    チャットの処理経路から書き込みを切り離すための非同期キュー。
+
+    put()はキューに積むだけですぐ返るので、ユーザーの送信から最初のトークンまでの間にDBの待ちが入らない。
+    バックグラウンドのタスクがmax_batch件たまるかflush_interval秒経つごとにまとめて書き込む。
+    SQLite(DBHandler)なら1回のトランザクションで、テーブルごとにinsert_manyでまとめて入れる。
+    AsyncDBHandlerを渡した場合は、その書き込みスレッドで実行する。
+    Supabase(SupabaseHandler)ならテーブルごとにbatch_insertを1回ずつ呼ぶ。
+    close()(またはasync withを抜けたとき)に残りを全部書き込んでから止まる。
+
+    async with WriteBehindQueue(db_handle) as writer:
+        await writer.put("user_messages", {"user_id": 1, "content": "..."})
+    """
+
+    def __init__(
+            self,
+            db_handle: Optional[DBHandler | AsyncDBHandler] = None,
+            supabase_handler: Any = None,
+            max_batch: int = 500,
+            flush_interval: float = 0.5,
+            max_queue: int = 10_000
+            ) -> None:
+        """
+        db_handle / supabase_handler : 書き込み先。どちらか一方を渡す。
+        max_batch : 1回の書き込みにまとめる最大件数。
+        flush_interval : 最初の1件が来てから書き込むまでの最大の待ち時間(秒)。
+        max_queue : キューに溜められる件数。溢れたらput()が空くまで待つ(背圧)。
+        """
+        if (db_handle is None) == (supabase_handler is None):
+            raise ValueError("db_handleかsupabase_handlerのどちらか一方を指定してください")
+        self.db_handle = db_handle
+        self.supabase_handler = supabase_handler
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def __aenter__(self) -> "WriteBehindQueue":
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.close()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, table_name: str, row: Dict[str, Any]) -> None:
+        """
+        1行分の書き込みを積む。キューが満杯のときだけ待つ。
+        """
+        self._check_open()
+        await self._queue.put((table_name, row))
+
+    async def put_call(self, func: Callable, *args: Any, **kwargs: Any) -> None:
+        """
+        行の挿入で表せない書き込み(MessageTree.append_messageなど)を積む。積んだ順に実行される。
+        func(handler, *args, **kwargs) の形で呼ばれ、handlerには書き込みに使うハンドラが渡される
+        (AsyncDBHandler.run_writeと同じ約束)。別のハンドラで書くと2本目のコネクションになり、
+        同じトランザクションに入らないうえ"database is locked"で待つことになるので、必ずhandlerを使うこと。
+        SQLiteならfuncは同期関数で、ほかの行と同じトランザクションの中で書き込み用のスレッドから呼ばれる。
+        戻り値がNoneなら失敗とみなしてバッチをrollbackする。Supabaseならfuncはasync関数で、handlerはSupabaseHandler。
+
+        await writer.put_call(lambda db: MessageTree(db).append_message(branch_id, "user", {"user_id": 1, "content": "..."}))
+        """
+        self._check_open()
+        await self._queue.put(_Call(func, args, kwargs))
+
+    async def flush(self) -> None:
+        """
+        ここまでに積んだ分が書き込まれるまで待つ。
+        """
+        await self._queue.join()
+
+    async def close(self) -> None:
+        """
+        新しい書き込みを受け付けるのをやめ、残りを全部書き込んでからワーカーを止める。
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._task is None:
+            return
+        await self._queue.put(_STOP)
+        await self._task
+        self._task = None
+
+    def _check_open(self) -> None:
+        if self._closed:
+            raise RuntimeError("WriteBehindQueue is closed")
+        self.start()
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            batch = []
+            if item is _STOP:
+                stopping = True
+            else:
+                batch.append(item)
+                deadline = loop.time() + self.flush_interval
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+            try:
+                if batch:
+                    await self._write(batch)
+            except Exception as e:
+                # ここで落ちるとワーカーが止まって以降の書き込みが全部失われるので、記録して続ける
+                logger.error("Write-behind batch failed", count=len(batch), error=str(e))
+            finally:
+                for _ in range(len(batch) + stopping):
+                    self._queue.task_done()
+
+    async def _write(self, batch: List[Any]) -> None:
+        if self.db_handle is not None:
+            try:
+                await self._run_sqlite(batch)
+            except Exception as e:
+                # 1件の不正なデータでバッチ全体を失わないよう、1件ずつ入れ直して悪いものだけ捨てる
+                logger.warning("Write-behind batch rolled back, retrying one by one", count=len(batch), error=str(e))
+                for item in batch:
+                    try:
+                        await self._run_sqlite([item])
+                    except Exception as item_error:
+                        logger.error("Write-behind dropped a record", item=repr(item)[:200], error=str(item_error))
+        else:
+            await self._write_supabase(batch)
+        logger.debug("Write-behind batch written", count=len(batch))
+
+    @staticmethod
+    def _groups(batch: List[Any]) -> List[List[Any]]:
+        """
+        連続する同じテーブルの行を1つのまとまりにする。順番は保つ。
+        """
+        def key(item):
+            return id(item) if isinstance(item, _Call) else item[0]
+        return [list(group) for _, group in groupby(batch, key=key)]
+
+    async def _run_sqlite(self, batch: List[Any]) -> None:
+        if isinstance(self.db_handle, AsyncDBHandler):
+            await self.db_handle.run_write(self._write_sqlite, batch)
+        else:
+            await asyncio.to_thread(self._write_sqlite_transaction, batch)
+
+    def _write_sqlite_transaction(self, batch: List[Any]) -> None:
+        with self.db_handle.transaction():
+            self._write_sqlite(self.db_handle, batch)
+
+    def _write_sqlite(self, db_handle: DBHandler, batch: List[Any]) -> None:
+        for group in self._groups(batch):
+            if isinstance(group[0], _Call):
+                call = group[0]
+                if call.func(db_handle, *call.args, **call.kwargs) is None:
+                    # DBHandlerのメソッドはエラーを握りつぶしてNoneを返すので、ここで例外にしてrollbackさせる
+                    raise RuntimeError(f"write-behind call {getattr(call.func, '__name__', call.func)!r} failed")
+                continue
+            table_name = group[0][0]
+            inserted = db_handle.insert_many(table_name, [row for _, row in group])
+            if inserted is None:
+                # insert_manyはエラーを握りつぶしてNoneを返すので、ここで例外にしてrollbackさせる
+                raise RuntimeError(f"insert_many failed for {table_name}")
+
+    async def _write_supabase(self, batch: List[Any]) -> None:
+        for group in self._groups(batch):
+            if isinstance(group[0], _Call):
+                call = group[0]
+                result = call.func(self.supabase_handler, *call.args, **call.kwargs)
+                if inspect.isawaitable(result):
+                    await result
+                continue
+            await self.supabase_handler.batch_insert(group[0][0], [row for _, row in group])
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Optional
+
+# src/をsys.pathに入れて models をトップレベルのパッケージとして読んだ場合は、database もトップレベルにある
+if __package__ and "." in __package__:
+    from ..database.DB_utils import DBHandler, load_schema
+else:
+    from database.DB_utils import DBHandler, load_schema
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionCache:
+    """
+    SQLite-backed cache of chat completions, stored through ``DBHandler`` in the ``llm_cache`` table.
+
+    Entries are keyed by a canonical hash of (model, messages, params), expire after ``ttl`` seconds
+    and the least recently used ones are evicted once the table holds more than ``max_entries``.
+    Only use it for requests whose answer may be reused, e.g. ``temperature=0`` or fixed FAQ prompts.
+    DB calls run in a worker thread so the event loop is never blocked on disk I/O.
+    """
+
+    def __init__(
+        self,
+        db_handle: DBHandler,
+        ttl: float = 24 * 60 * 60,
+        max_entries: int = 10_000,
+        schema_path: str = "config/db_schema/llm_cache.json",
+        evict_every: int = 100,
+    ) -> None:
+        """
+        Args:
+            db_handle (DBHandler): Handler for the SQLite database holding the cache table.
+            ttl (float): Seconds an entry stays valid.
+            max_entries (int): Maximum number of cached completions.
+            schema_path (str): Schema of the cache table, created on first use.
+            evict_every (int): Check the size bound after this many writes.
+        """
+        self.db_handle = db_handle
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._schema = load_schema(schema_path)
+        self._table = self._schema["table_name"]
+        self._ready = False
+        self._writes = 0
+
+    @staticmethod
+    def make_key(model: str, messages: list[dict[str, str]], params: Optional[dict[str, Any]] = None) -> str:
+        """Canonical hash of a request; key order and whitespace do not affect it."""
+        canonical = json.dumps(
+            {"model": model, "messages": messages, "params": params or {}},
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _ensure_table(self) -> None:
+        if not self._ready:
+            self.db_handle.migrate_table(self._schema)
+            self._ready = True
+
+    def _get(self, key: str) -> Optional[dict[str, Any]]:
+        self._ensure_table()
+        now = time.time()
+        rows = self.db_handle.fetch_all(
+            f"SELECT id, response, created FROM {self._table} WHERE cache_key = ?", (key,)
+        )
+        if not rows:
+            return None
+        row_id, response, created = rows[0]
+        if created + self.ttl < now:
+            self.db_handle.execute(f"DELETE FROM {self._table} WHERE id = ?", (row_id,))
+            return None
+        self.db_handle.execute(f"UPDATE {self._table} SET last_access = ? WHERE id = ?", (now, row_id))
+        return json.loads(response)
+
+    def _put(self, key: str, model: str, response: dict[str, Any]) -> None:
+        self._ensure_table()
+        now = time.time()
+        self.db_handle.upsert_data(
+            self._table,
+            {
+                "cache_key": key,
+                "model": model,
+                "response": json.dumps(response, ensure_ascii=False),
+                "created": now,
+                "last_access": now,
+            },
+        )
+        self._writes += 1
+        if self._writes % self.evict_every == 0:
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        with self.db_handle.transaction():
+            self.db_handle.execute(f"DELETE FROM {self._table} WHERE created < ?", (now - self.ttl,))
+            overflow = (self.db_handle.count_data(self._table) or 0) - self.max_entries
+            if overflow > 0:
+                self.db_handle.execute(
+                    f"DELETE FROM {self._table} WHERE id IN "
+                    f"(SELECT id FROM {self._table} ORDER BY last_access LIMIT ?)",
+                    (overflow,),
+                )
+                logger.info(f"Evicted {overflow} cached completions")
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        """Return the cached response for ``key``, or None if missing or expired."""
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key: str, model: str, response: dict[str, Any]) -> None:
+        """Store ``response`` (an OpenAI-style completion dict) under ``key``."""
+        await asyncio.to_thread(self._put, key, model, response)
+
+
+def response_from_stream(content: str, meta: Optional[dict[str, Any]], model: str) -> dict[str, Any]:
+    """Build a non-streaming style response from streamed content and its metadata."""
+    meta = meta or {}
+    return {
+        "id": meta.get("id"),
+        "model": meta.get("model") or model,
+        "created": meta.get("created"),
+        "object": "chat.completion",
+        "system_fingerprint": meta.get("system_fingerprint"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": meta.get("prompt_tokens"),
+            "completion_tokens": meta.get("completion_tokens"),
+        },
+    }
@@ -0,0 +1,171 @@
+import hashlib
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+# src/をsys.pathに入れて models をトップレベルのパッケージとして読んだ場合は、database もトップレベルにある
+if __package__ and "." in __package__:
+    from ..database.message_tree import estimate_tokens, split_messages
+else:
+    from database.message_tree import estimate_tokens, split_messages
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # optional: pip install chat-management[tokens]
+    tiktoken = None
+
+
+# Context sizes of the models we route to; unknown models fall back to DEFAULT_CONTEXT_TOKENS
+MODEL_CONTEXT_TOKENS = {
+    "openai/gpt-3.5-turbo": 16385,
+    "openai/gpt-4o": 128000,
+    "openai/gpt-4o-mini": 128000,
+    "anthropic/claude-3-sonnet": 200000,
+    "anthropic/claude-3-haiku": 200000,
+    "anthropic/claude-3-opus": 200000,
+}
+DEFAULT_CONTEXT_TOKENS = 8192
+
+# Role/formatting overhead per message, as in OpenAI's chat token accounting
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+
+class TokenCounter:
+    """
+    Counts tokens per message text, memoised by content hash.
+
+    Stored messages never change, so the memo effectively caches one count per stored message
+    row; repeated turns of a long conversation are counted once. Uses tiktoken when installed
+    and a character-based estimate otherwise (ASCII ~4 chars per token, CJK ~1 char per token).
+    """
+
+    def __init__(self, encoding: str = "cl100k_base", cache_size: int = 50_000) -> None:
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[bytes, int]" = OrderedDict()
+        self._encoder = tiktoken.get_encoding(encoding) if tiktoken is not None else None
+
+    def _count_uncached(self, text: str) -> int:
+        if self._encoder is not None:
+            return len(self._encoder.encode(text, disallowed_special=()))
+        return estimate_tokens(text)
+
+    def count_text(self, text: Optional[str]) -> int:
+        """Tokens in ``text`` (0 for empty or None)."""
+        if not text:
+            return 0
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        count = self._cache.get(key)
+        if count is None:
+            count = self._count_uncached(text)
+            self._cache[key] = count
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return count
+
+    def count_message(self, message: dict[str, str]) -> int:
+        return TOKENS_PER_MESSAGE + self.count_text(message.get("content"))
+
+    def count_messages(self, messages: list[dict[str, str]]) -> int:
+        """Prompt tokens the messages will cost, including per-message overhead."""
+        return sum(self.count_message(message) for message in messages) + TOKENS_PER_REPLY
+
+
+@dataclass
+class FitResult:
+    """Messages trimmed to the budget and what it took to get there."""
+
+    messages: list[dict[str, str]]
+    prompt_tokens: int
+    dropped: list[dict[str, str]] = field(default_factory=list)
+
+
+class ContextWindow:
+    """
+    Keeps a conversation inside a model's prompt budget before it is sent.
+
+    System messages and the latest message are always kept; older turns are dropped oldest
+    first until the prompt fits. With a ``summarizer`` the dropped turns are replaced by a short
+    system message summarising them instead of being lost entirely.
+    """
+
+    def __init__(
+        self,
+        model: str,
+        max_prompt_tokens: Optional[int] = None,
+        reserve_completion_tokens: int = 1024,
+        counter: Optional[TokenCounter] = None,
+        summarizer: Optional[Callable[[list[dict[str, str]]], Awaitable[str]]] = None,
+    ) -> None:
+        """
+        Args:
+            model (str): Model the conversation is sent to; selects the default budget.
+            max_prompt_tokens (Optional[int]): Explicit prompt budget. Defaults to the model context minus the reserve.
+            reserve_completion_tokens (int): Tokens left free for the answer.
+            counter (Optional[TokenCounter]): Shared counter, so its memo is reused across conversations.
+            summarizer (Optional[Callable]): Async function turning dropped messages into a summary text.
+        """
+        self.model = model
+        context = MODEL_CONTEXT_TOKENS.get(model, DEFAULT_CONTEXT_TOKENS)
+        self.max_prompt_tokens = max_prompt_tokens or max(0, context - reserve_completion_tokens)
+        self.counter = counter or TokenCounter()
+        self.summarizer = summarizer
+
+    def count(self, messages: list[dict[str, str]]) -> int:
+        """Prompt tokens of ``messages`` as they would be sent now."""
+        return self.counter.count_messages(messages)
+
+    def fit(self, messages: list[dict[str, str]], budget: Optional[int] = None) -> FitResult:
+        """
+        Drop the oldest non-system messages until the prompt fits the budget.
+
+        Args:
+            messages (list[dict[str, str]]): The full conversation.
+            budget (Optional[int]): Override of max_prompt_tokens for this call.
+
+        Returns:
+            FitResult: The kept messages (in order), their token count and the dropped messages.
+        """
+        budget = self.max_prompt_tokens if budget is None else budget
+        counts = [self.counter.count_message(message) for message in messages]
+        kept, dropped, total = split_messages(messages, budget - TOKENS_PER_REPLY, counts)
+        total += TOKENS_PER_REPLY
+        if total > budget:
+            logger.warning(f"Conversation needs {total} tokens even after trimming (budget {budget})")
+        return FitResult(kept, total, dropped)
+
+    async def fit_with_summary(self, messages: list[dict[str, str]]) -> FitResult:
+        """
+        Like ``fit``, but replaces dropped turns with a summary from the summarizer.
+
+        Falls back to plain trimming when no summarizer is set or nothing had to be dropped.
+        The summary itself takes budget, so the conversation is refitted around it; if that drops
+        more turns, they are summarised too until every dropped turn is covered by the summary.
+        """
+        if self.summarizer is None:
+            return self.fit(messages)
+        result = self.fit(messages)
+        if not result.dropped:
+            return result
+
+        summarized: set[int] = set()
+        while not all(id(message) in summarized for message in result.dropped):
+            summarized.update(id(message) for message in result.dropped)
+            dropped = [message for message in messages if id(message) in summarized]
+            summary = await self.summarizer(dropped)
+            summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {summary}"}
+            summary_tokens = self.counter.count_message(summary_message)
+            result = self.fit(messages, budget=self.max_prompt_tokens - summary_tokens)
+
+        # A shorter summary may leave room for turns it already covers; don't send them twice
+        kept = [message for message in messages if id(message) not in summarized]
+        system_count = 0
+        while system_count < len(kept) and kept[system_count].get("role") == "system":
+            system_count += 1
+        kept.insert(system_count, summary_message)
+        return FitResult(kept, self.count(kept), dropped)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import weakref
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    """Connection limits for the shared HTTP client."""
+
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 10.0
+    read_timeout: Optional[float] = 120.0
+    http2: bool = True
+
+
+class HTTPClientPool:
+    """
+    Hands out one long-lived ``httpx.AsyncClient`` per event loop.
+
+    Every LLMClient borrowing from the same pool reuses its connections, so TLS and HTTP/2 setup
+    is paid once per host instead of once per request; with HTTP/2 concurrent requests to the same
+    host are multiplexed over a single connection. httpx clients are bound to the loop they were
+    first used on, which is why clients are kept per loop.
+    """
+
+    def __init__(self, config: Optional[PoolConfig] = None) -> None:
+        self.config = config or PoolConfig()
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = weakref.WeakKeyDictionary()
+
+    def _create_client(self) -> httpx.AsyncClient:
+        config = self.config
+        return httpx.AsyncClient(
+            http2=config.http2,
+            limits=httpx.Limits(
+                max_connections=config.max_connections,
+                max_keepalive_connections=config.max_keepalive_connections,
+                keepalive_expiry=config.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(config.read_timeout, connect=config.connect_timeout),
+        )
+
+    def get_client(self) -> httpx.AsyncClient:
+        """
+        Return the client for the running event loop, creating it on first use.
+
+        Raises:
+            RuntimeError: If called outside a running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = self._create_client()
+            self._clients[loop] = client
+        return client
+
+    async def aclose(self) -> None:
+        """Close the client belonging to the running event loop."""
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+_default_pool: Optional[HTTPClientPool] = None
+
+
+def get_default_pool() -> HTTPClientPool:
+    """Return the process-wide pool used by LLMClient when no pool is given."""
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = HTTPClientPool()
+    return _default_pool
+
+
+def configure_default_pool(config: PoolConfig) -> HTTPClientPool:
+    """
+    Replace the process-wide pool with one using ``config``.
+
+    Call this at startup, before any client has been borrowed.
+    """
+    global _default_pool
+    _default_pool = HTTPClientPool(config)
+    return _default_pool
+
+
+@asynccontextmanager
+async def pool_lifespan(app: Any = None, config: Optional[PoolConfig] = None) -> AsyncIterator[None]:
+    """
+    FastAPI lifespan that opens the shared pool at startup and closes it at shutdown.
+
+    Usage:
+        app = FastAPI(lifespan=pool_lifespan)
+    """
+    pool = configure_default_pool(config) if config else get_default_pool()
+    pool.get_client()
+    try:
+        yield
+    finally:
+        await pool.aclose()
+        logger.info("Shared HTTP client pool closed")
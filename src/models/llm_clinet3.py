@@ -1,15 +1,53 @@
+# このファイルはパッケージ内の相対importを使うので、単体で動かすときはリポジトリのルートから
+#   python -m src.models.llm_clinet3
+# で実行する(python src/models/llm_clinet3.py では親パッケージが無く、importに失敗する)
+if __name__ == "__main__" and not __package__:
+    raise SystemExit("Run this demo from the repository root: python -m src.models.llm_clinet3")
+
 import asyncio
-import json
 import logging
 import os
-from typing import Any, AsyncGenerator, Optional
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Awaitable, Callable, Iterable, Optional
 
 import httpx
 
+from .http_pool import HTTPClientPool, get_default_pool
+from .metrics import MetricsRecorder, RequestTracker
+from .rate_limit import (
+    BATCH,
+    INTERACTIVE,
+    RateLimitScheduler,
+    estimate_request_tokens,
+    jittered_backoff,
+    parse_retry_after,
+)
+from .sse import aiter_sse
+from .stream_json import ChunkDecoder, StreamDelta, extract_meta_data
+
+if TYPE_CHECKING:
+    # completion_cacheはdatabaseパッケージに依存するので、cache=を渡したときだけ読み込む
+    from .completion_cache import CompletionCache
+
 # ロギングの設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class PartialStreamError(httpx.HTTPError):
+    """
+    Raised when a stream fails after some content was already yielded.
+
+    Retrying from scratch would repeat that content to the caller, so the text received so far
+    is attached instead and the caller decides how to continue.
+
+    Attributes:
+        partial_content (str): Everything yielded before the failure.
+    """
+
+    def __init__(self, message: str, partial_content: str) -> None:
+        super().__init__(message)
+        self.partial_content = partial_content
+
+
 class LLMClient:
     """A client for interacting with LLM APIs."""
 
@@ -18,6 +56,11 @@ class LLMClient:
         model: str = "openai/gpt-3.5-turbo",
         url: str = "https://openrouter.ai/api/v1/chat/completions",
         api_key: Optional[str] = None,
+        json_backend: Optional[str] = None,
+        pool: Optional[HTTPClientPool] = None,
+        rate_limiter: Optional[RateLimitScheduler] = None,
+        cache: Optional["CompletionCache"] = None,
+        metrics: Optional[MetricsRecorder] = None,
     ) -> None:
         """
         Initialize the LLMClient.
@@ -26,6 +69,12 @@ class LLMClient:
             model (str): The model to use for completions.
             url (str): The API endpoint URL.
             api_key (Optional[str]): The API key. If not provided, it will be read from the OPENROUTER_API_KEY environment variable.
+            json_backend (Optional[str]): JSON backend for streamed chunks ("msgspec", "orjson" or "json"). Defaults to the fastest installed.
+            pool (Optional[HTTPClientPool]): Pool to borrow the HTTP/2 client from. Defaults to the process-wide pool.
+            rate_limiter (Optional[RateLimitScheduler]): Scheduler enforcing request/token budgets. Share one instance
+                between clients that use the same API key.
+            cache (Optional[CompletionCache]): Cache for completions whose answers may be reused.
+            metrics (Optional[MetricsRecorder]): Recorder for latency and token usage of every request sent to the API.
 
         Raises:
             ValueError: If the API key is not provided and not found in the environment variables.
@@ -44,15 +93,20 @@ class LLMClient:
             "Content-Type": "application/json",
         }
         
+        self.chunk_decoder = ChunkDecoder(json_backend)
+        self.pool = pool
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.metrics = metrics
         self.client = None
 
     async def __aenter__(self):
-        self.client = httpx.AsyncClient(http2=True)
+        # The client is shared with every other LLMClient on this pool, so it is borrowed, not owned
+        self.client = (self.pool or get_default_pool()).get_client()
         return self
 
     async def __aexit__(self, exc_type, exc_value, traceback) -> None:
-        if self.client:
-            await self.client.aclose()
+        self.client = None
         if exc_type:
             logger.error(f"An error occurred: {exc_type.__name__}: {exc_value}")
 
@@ -63,6 +117,11 @@ class LLMClient:
         include_meta_data: bool = False,
         max_retries: int = 3,
         backoff_factor: float = 0.5,
+        priority: int = INTERACTIVE,
+        resume: bool = False,
+        params: Optional[dict[str, Any]] = None,
+        use_cache: bool = True,
+        user: Optional[str] = None,
     ) -> dict[str, Any] | AsyncGenerator[str | dict[str, Any], None]:
         """
         Post a chat completion request to the API.
@@ -72,43 +131,278 @@ class LLMClient:
             stream (bool): Whether to stream the response.
             include_meta_data (bool): Whether to include metadata in the response.
             max_retries (int): Maximum number of retries for failed requests.
-            backoff_factor (float): Factor to determine the delay between retries.
+            backoff_factor (float): Factor to determine the delay between retries (with full jitter).
+            priority (int): Queue priority when a rate limiter is set; lower is served first.
+            resume (bool): Streaming only. If the stream breaks after content was yielded, re-request with the
+                partial answer as an assistant prefix and yield only the continuation. Requires a model/provider
+                that continues a trailing assistant message. When False, such a failure raises PartialStreamError.
+            params (Optional[dict[str, Any]]): Extra request parameters such as temperature or max_tokens.
+            use_cache (bool): Whether to read and write the completion cache, if one is configured.
+                Cached streams are replayed through the same generator interface.
+            user (Optional[str]): User the request is attributed to in its timing record (not a metrics label).
 
         Returns:
             dict[str, Any] | AsyncGenerator[str | dict[str, Any], None]: The API response or a generator of response chunks.
 
         Raises:
             httpx.HTTPError: If an HTTP error occurs after all retries have been exhausted.
+            PartialStreamError: If a stream fails mid-way and resume is False, or resuming still fails after all
+                retries (raised from the generator).
             RuntimeError: If the client is not initialized.
         """
         if not self.client:
             raise RuntimeError("Client is not initialized. Use 'async with' to initialize the client.")
 
-        data = {"model": self.model, "messages": messages, "stream": stream}
+        data = {**(params or {}), "model": self.model, "messages": messages, "stream": stream}
+
+        cache_key = None
+        if self.cache is not None and use_cache:
+            cache_key = self.cache.make_key(self.model, messages, params)
+            cached = await self.cache.get(cache_key)
+            if cached is not None:
+                logger.info("Completion cache hit")
+                if stream:
+                    return self._replay_cached(cached, include_meta_data)
+                return cached if include_meta_data else cached["choices"][0]["message"]["content"]
 
         if stream:
-            return self._stream_response(data, include_meta_data, max_retries, backoff_factor)
-        else:
-            for attempt in range(max_retries):
+            # Downstream wrappers need the metadata chunk even if the caller does not
+            keep_meta = include_meta_data or cache_key is not None
+            chunks = self._stream_response(
+                data, keep_meta or self.metrics is not None, max_retries, backoff_factor, priority, resume
+            )
+            if self.metrics is not None:
+                chunks = self._measure_stream(chunks, user, keep_meta)
+            if cache_key is not None:
+                return self._stream_and_cache(chunks, cache_key, include_meta_data)
+            return chunks
+
+        tracker = self.metrics.start_request(self.model, user) if self.metrics is not None else None
+        try:
+            response_data = await self._post_response(data, max_retries, backoff_factor, priority)
+        except BaseException:
+            if tracker is not None:
+                tracker.finish(error=True)
+            raise
+        if tracker is not None:
+            tracker.usage(extract_meta_data(response_data))
+            tracker.finish()
+        if cache_key is not None:
+            await self.cache.put(cache_key, self.model, response_data)
+        if not include_meta_data:
+            return response_data["choices"][0]["message"]["content"]
+        return response_data
+
+    async def _post_response(
+        self,
+        data: dict[str, Any],
+        max_retries: int,
+        backoff_factor: float,
+        priority: int,
+    ) -> dict[str, Any]:
+        for attempt in range(max_retries):
+            estimated = await self._acquire_slot(data, priority)
+            try:
+                response = await self.client.post(
+                    self.url, headers=self.headers, json=data
+                )
+                self._observe_headers(data, response)
+                response.raise_for_status()
+                response_data = response.json()
+                self._record_usage(data, estimated, response_data.get("usage"))
+                return response_data
+            except httpx.HTTPError as e:
+                if attempt == max_retries - 1:
+                    logger.error(f"Failed to get response after {max_retries} attempts: {e}")
+                    raise
+                wait_time = self._retry_delay(e, attempt, backoff_factor)
+                logger.warning(f"Request failed. Retrying in {wait_time:.2f} seconds...")
+                await asyncio.sleep(wait_time)
+            except Exception as e:
+                logger.error(f"An unexpected error occurred: {e}")
+                raise
+
+    async def _stream_and_cache(
+        self,
+        chunks: AsyncGenerator[str | dict[str, Any], None],
+        cache_key: str,
+        include_meta_data: bool,
+    ) -> AsyncGenerator[str | dict[str, Any], None]:
+        parts: list[str] = []
+        meta = None
+        async for chunk in chunks:
+            if isinstance(chunk, str):
+                parts.append(chunk)
+                yield chunk
+            else:
+                meta = chunk
+                if include_meta_data:
+                    yield chunk
+        # Only reached when the stream completed, so partial answers are never cached
+        from .completion_cache import response_from_stream
+
+        await self.cache.put(cache_key, self.model, response_from_stream("".join(parts), meta, self.model))
+
+    async def _measure_stream(
+        self,
+        chunks: AsyncGenerator[str | dict[str, Any], None],
+        user: Optional[str],
+        keep_meta: bool,
+    ) -> AsyncGenerator[str | dict[str, Any], None]:
+        # Started on first iteration, so TTFT covers rate-limit queueing but not the caller's delay
+        tracker: RequestTracker = self.metrics.start_request(self.model, user)
+        error = True
+        try:
+            async for chunk in chunks:
+                if isinstance(chunk, str):
+                    tracker.token()
+                    yield chunk
+                else:
+                    tracker.usage(chunk)
+                    if keep_meta:
+                        yield chunk
+            error = False
+        finally:
+            tracker.finish(error=error)
+
+    @staticmethod
+    async def _replay_cached(
+        cached: dict[str, Any],
+        include_meta_data: bool,
+        chunk_size: int = 32,
+    ) -> AsyncGenerator[str | dict[str, Any], None]:
+        content = cached["choices"][0]["message"]["content"] or ""
+        for start in range(0, len(content), chunk_size):
+            yield content[start:start + chunk_size]
+        if include_meta_data:
+            yield extract_meta_data(cached)
+
+    async def _acquire_slot(self, data: dict[str, Any], priority: int) -> int:
+        if self.rate_limiter is None:
+            return 0
+        estimated = estimate_request_tokens(data["messages"], data.get("max_tokens"))
+        await self.rate_limiter.acquire(data["model"], self.api_key, estimated, priority)
+        return estimated
+
+    def _observe_headers(self, data: dict[str, Any], response: httpx.Response) -> None:
+        if self.rate_limiter is not None:
+            self.rate_limiter.update_from_headers(data["model"], self.api_key, response.headers)
+
+    def _record_usage(self, data: dict[str, Any], estimated: int, usage: Optional[dict[str, Any]]) -> None:
+        if self.rate_limiter is None or not usage:
+            return
+        actual = (usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0)
+        self.rate_limiter.record_usage(data["model"], self.api_key, estimated, actual)
+
+    @staticmethod
+    def _retry_delay(error: httpx.HTTPError, attempt: int, backoff_factor: float) -> float:
+        delay = jittered_backoff(attempt, backoff_factor)
+        if isinstance(error, httpx.HTTPStatusError):
+            retry_after = parse_retry_after(error.response.headers)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+        return delay
+
+    async def post_chat_completions_many(
+        self,
+        requests: Iterable[list[dict[str, str]]],
+        concurrency: int = 8,
+        as_completed: bool = False,
+        include_meta_data: bool = False,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        priority: int = BATCH,
+    ) -> list[Any] | AsyncGenerator[tuple[int, Any], None]:
+        """
+        Run many non-streaming chat completions concurrently over the shared connection.
+
+        At most ``concurrency`` requests are in flight at once and ``requests`` is consumed lazily,
+        so it can be a generator over thousands of documents. A failing item does not affect the
+        others: its exception is returned in place of its result.
+
+        Args:
+            requests (Iterable[list[dict[str, str]]]): One message list per completion.
+            concurrency (int): Maximum number of requests in flight.
+            as_completed (bool): If True, return an async generator of ``(index, result)`` pairs in
+                completion order instead of a list in input order.
+            include_meta_data (bool): Whether to return the full response instead of the content.
+            max_retries (int): Maximum number of retries per request.
+            backoff_factor (float): Factor to determine the delay between retries.
+            priority (int): Queue priority when a rate limiter is set. Defaults to BATCH so interactive chat goes first.
+
+        Returns:
+            list[Any] | AsyncGenerator[tuple[int, Any], None]: Results (or exceptions) in input order,
+            or a generator yielding them as they complete.
+
+        Raises:
+            RuntimeError: If the client is not initialized.
+            ValueError: If concurrency is less than 1.
+        """
+        if not self.client:
+            raise RuntimeError("Client is not initialized. Use 'async with' to initialize the client.")
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+
+        options = {
+            "include_meta_data": include_meta_data,
+            "max_retries": max_retries,
+            "backoff_factor": backoff_factor,
+            "priority": priority,
+        }
+        if as_completed:
+            return self._completions_as_completed(requests, concurrency, options)
+
+        results: dict[int, Any] = {}
+
+        async def store(index: int, result: Any) -> None:
+            results[index] = result
+
+        await self._run_completions(requests, concurrency, options, store)
+        return [results[index] for index in range(len(results))]
+
+    async def _run_completions(
+        self,
+        requests: Iterable[list[dict[str, str]]],
+        concurrency: int,
+        options: dict[str, Any],
+        on_result: Callable[[int, Any], Awaitable[None]],
+    ) -> None:
+        pending = enumerate(requests)
+
+        async def worker() -> None:
+            # Workers share one iterator; next() never awaits, so each item is taken exactly once
+            for index, messages in pending:
                 try:
-                    response = await self.client.post(
-                        self.url, headers=self.headers, json=data
-                    )
-                    response.raise_for_status()
-                    response_data = response.json()
-                    if not include_meta_data:
-                        response_data = response_data["choices"][0]["message"]["content"]
-                    return response_data
-                except httpx.HTTPError as e:
-                    if attempt == max_retries - 1:
-                        logger.error(f"Failed to get response after {max_retries} attempts: {e}")
-                        raise
-                    wait_time = backoff_factor * (2 ** attempt)
-                    logger.warning(f"Request failed. Retrying in {wait_time:.2f} seconds...")
-                    await asyncio.sleep(wait_time)
+                    result = await self.post_chat_completion(messages, stream=False, **options)
                 except Exception as e:
-                    logger.error(f"An unexpected error occurred: {e}")
-                    raise
+                    logger.warning(f"Completion {index} failed: {e}")
+                    result = e
+                await on_result(index, result)
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    async def _completions_as_completed(
+        self,
+        requests: Iterable[list[dict[str, str]]],
+        concurrency: int,
+        options: dict[str, Any],
+    ) -> AsyncGenerator[tuple[int, Any], None]:
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        async def produce() -> None:
+            try:
+                await self._run_completions(requests, concurrency, options, lambda i, r: queue.put((i, r)))
+            finally:
+                await queue.put(done)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (item := await queue.get()) is not done:
+                yield item
+            await producer
+        finally:
+            producer.cancel()
 
     async def _stream_response(
         self,
@@ -116,67 +410,79 @@ class LLMClient:
         include_meta_data: bool,
         max_retries: int,
         backoff_factor: float,
+        priority: int = INTERACTIVE,
+        resume: bool = False,
     ) -> AsyncGenerator[str | dict[str, Any], None]:
+        emitted: list[str] = []
+        request_data = data
         for attempt in range(max_retries):
+            estimated = await self._acquire_slot(request_data, priority)
             try:
                 async with self.client.stream(
-                    "POST", self.url, headers=self.headers, json=data
+                    "POST", self.url, headers=self.headers, json=request_data
                 ) as response:
+                    self._observe_headers(request_data, response)
                     response.raise_for_status()
-                    buffer = ""
-                    async for raw_chunk in response.aiter_raw():
-                        buffer += raw_chunk.decode("utf-8")
-                        while "\n" in buffer:
-                            chunk, buffer = buffer.split("\n", 1)
-                            if chunk.strip():
-                                parsed_data = self._parse_chunk(chunk)
-                                if isinstance(parsed_data, str):
-                                    yield parsed_data
-                                elif isinstance(parsed_data, dict) and include_meta_data:
-                                    yield parsed_data
+                    async for event in aiter_sse(response.aiter_bytes()):
+                        delta = self._parse_chunk(event.data)
+                        if delta.content:
+                            emitted.append(delta.content)
+                            yield delta.content
+                        if delta.meta is not None:
+                            self._record_usage(request_data, estimated, delta.meta)
+                            if include_meta_data:
+                                yield delta.meta
                 return
             except httpx.HTTPError as e:
+                if emitted and not resume:
+                    logger.error(f"Stream failed after partial output: {e}")
+                    raise PartialStreamError(f"Stream failed after partial output: {e}", "".join(emitted)) from e
                 if attempt == max_retries - 1:
                     logger.error(f"Failed to stream response after {max_retries} attempts: {e}")
+                    if emitted:
+                        # The caller already has part of the answer; hand it back with the failure
+                        raise PartialStreamError(
+                            f"Stream failed after {max_retries} attempts with partial output: {e}", "".join(emitted)
+                        ) from e
                     raise
-                wait_time = backoff_factor * (2 ** attempt)
+                if emitted:
+                    # Continue from what the caller already has instead of starting over
+                    request_data = self._continuation_request(data, "".join(emitted))
+                wait_time = self._retry_delay(e, attempt, backoff_factor)
                 logger.warning(f"Streaming failed. Retrying in {wait_time:.2f} seconds...")
                 await asyncio.sleep(wait_time)
             except Exception as e:
                 logger.error(f"An unexpected error occurred while streaming: {e}")
                 raise
 
-    def _parse_chunk(self, chunk: str) -> str | dict[str, Any]:
+    @staticmethod
+    def _continuation_request(data: dict[str, Any], partial_content: str) -> dict[str, Any]:
+        return {
+            **data,
+            "messages": [*data["messages"], {"role": "assistant", "content": partial_content}],
+        }
+
+    def _parse_chunk(self, chunk: str) -> StreamDelta:
         chunk = chunk.strip()
         if chunk.startswith("data:"):
             chunk = chunk[5:].strip()
         #chunk = chunk.lstrip("data:").strip()←こうだと何故かダメ!
         if chunk == "[DONE]" or ": OPENROUTER" in chunk:
-            return ""
+            return StreamDelta()
         try:
-            data = json.loads(chunk)
-            if "usage" in data:
-                return self._extract_meta_data(data)
-            content = data["choices"][0]["delta"].get("content", "")
-            return content
-        except json.JSONDecodeError:
+            # A chunk can carry both the last content delta and the usage block,
+            # and "usage": null does not make it metadata
+            return self.chunk_decoder.decode(chunk)
+        except ValueError:
             logger.warning(f"Failed to parse JSON: {chunk}")
-            return chunk
-        except KeyError as e:
+            return StreamDelta(content=chunk)
+        except (KeyError, IndexError, AttributeError, TypeError) as e:
             logger.warning(f"Unexpected data structure: {e}")
-            return ""
-        
+            return StreamDelta()
+
     @staticmethod
     def _extract_meta_data(data: dict[str, Any]) -> dict[str, Any]:
-        return {
-            "id": data.get("id"),
-            "model": data.get("model"),
-            "prompt_tokens": data.get("usage", {}).get("prompt_tokens"),#usageというdictの中にさらに内包されているためこういう書き方
-            "completion_tokens": data.get("usage", {}).get("completion_tokens"),
-            "created": data.get("created"),
-            "object": data.get("object"),
-            "system_fingerprint": data.get("system_fingerprint")
-        }
+        return extract_meta_data(data)
 
 async def main():
     async with LLMClient() as llm:
@@ -203,4 +509,5 @@ async def main():
         print()  # Add a newline at the end of the response
 
 if __name__ == "__main__":
+    # python -m src.models.llm_clinet3
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Bucket upper bounds in seconds (tokens/s for throughput)
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+INTER_TOKEN_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+DURATION_BUCKETS = (0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+TOKENS_PER_SECOND_BUCKETS = (5.0, 10.0, 20.0, 40.0, 60.0, 80.0, 120.0, 200.0, 400.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram; ``observe`` is a bisect and two additions."""
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram") -> None:
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        """(le, count) pairs in Prometheus order, ending with +Inf."""
+        total = 0
+        pairs = []
+        for bound, count in zip((*map(str, self.bounds), "+Inf"), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+@dataclass
+class RequestRecord:
+    """
+    Timings and usage of one finished request, kept until flushed to the database.
+
+    ``user`` is kept here for the per-message rows only; it is not a metrics label.
+    """
+
+    gen_id: Optional[str]
+    model: str
+    user: str
+    ttft: Optional[float]
+    duration: float
+    tokens_per_second: Optional[float]
+    prompt_tokens: Optional[int]
+    completion_tokens: Optional[int]
+    error: bool
+    flush_attempts: int = 0
+
+
+class _Series:
+    """All aggregates for one model."""
+
+    def __init__(self) -> None:
+        self.ttft = Histogram(TTFT_BUCKETS)
+        self.inter_token = Histogram(INTER_TOKEN_BUCKETS)
+        self.duration = Histogram(DURATION_BUCKETS)
+        self.tokens_per_second = Histogram(TOKENS_PER_SECOND_BUCKETS)
+        self.requests = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+
+class RequestTracker:
+    """
+    Measures a single request. Not thread-safe; one tracker belongs to one request.
+
+    Inter-token gaps go into a private histogram that is merged into the recorder once, in
+    ``finish``, so the per-token cost is a clock read and a bisect with no locking.
+    """
+
+    def __init__(self, recorder: "MetricsRecorder", model: str, user: str) -> None:
+        self.recorder = recorder
+        self.model = model
+        self.user = user
+        self.started = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.last_token: Optional[float] = None
+        self.chunks = 0
+        self.inter_token = Histogram(INTER_TOKEN_BUCKETS)
+        self.meta: dict[str, Any] = {}
+        self.finished = False
+
+    def token(self) -> None:
+        """Call for every content chunk as it arrives."""
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+        else:
+            self.inter_token.observe(now - self.last_token)
+        self.last_token = now
+        self.chunks += 1
+
+    def usage(self, meta: Optional[dict[str, Any]]) -> None:
+        """Attach the metadata (id, prompt_tokens, completion_tokens) reported by the API."""
+        if meta:
+            self.meta = meta
+
+    def finish(self, error: bool = False) -> None:
+        """Record the request; later calls are ignored."""
+        if self.finished:
+            return
+        self.finished = True
+        end = time.perf_counter()
+        duration = end - self.started
+        ttft = self.first_token - self.started if self.first_token is not None else None
+
+        completion_tokens = self.meta.get("completion_tokens")
+        produced = completion_tokens if completion_tokens is not None else self.chunks
+        # Throughput of generation only: time spent waiting for the first token is TTFT's concern
+        generating = end - self.first_token if self.first_token is not None else duration
+        tokens_per_second = produced / generating if produced and generating > 0 else None
+
+        self.recorder._record(
+            self,
+            RequestRecord(
+                gen_id=self.meta.get("id"),
+                model=self.model,
+                user=self.user,
+                ttft=ttft,
+                duration=duration,
+                tokens_per_second=tokens_per_second,
+                prompt_tokens=self.meta.get("prompt_tokens"),
+                completion_tokens=completion_tokens,
+                error=error,
+            ),
+        )
+
+
+class MetricsRecorder:
+    """
+    In-memory aggregator of LLM request metrics, labelled by model.
+
+    Users are deliberately not a label: every distinct user would add a full set of series.
+
+    Records time to first token, inter-token latency, total duration, tokens per second and
+    token usage as histograms/counters. ``render_prometheus`` produces the text exposition format
+    for a ``/metrics`` endpoint, and finished requests are buffered so ``periodic_flush`` can store
+    their timings on the matching ``llm_messages`` rows.
+    """
+
+    def __init__(self, max_pending: int = 10_000) -> None:
+        """
+        Args:
+            max_pending (int): Finished requests kept for the database flush; the oldest are dropped beyond this.
+        """
+        self._lock = threading.Lock()
+        self._series: dict[str, _Series] = {}
+        self._pending: deque[RequestRecord] = deque(maxlen=max_pending)
+
+    def start_request(self, model: str, user: Optional[str] = None) -> RequestTracker:
+        """Begin measuring a request; call ``finish`` on the returned tracker when it ends."""
+        return RequestTracker(self, model, user or "")
+
+    def _record(self, tracker: RequestTracker, record: RequestRecord) -> None:
+        with self._lock:
+            series = self._series.get(record.model)
+            if series is None:
+                series = self._series[record.model] = _Series()
+            series.requests += 1
+            series.duration.observe(record.duration)
+            series.inter_token.merge(tracker.inter_token)
+            if record.error:
+                series.errors += 1
+            if record.ttft is not None:
+                series.ttft.observe(record.ttft)
+            if record.tokens_per_second is not None:
+                series.tokens_per_second.observe(record.tokens_per_second)
+            series.prompt_tokens += record.prompt_tokens or 0
+            series.completion_tokens += record.completion_tokens or 0
+            if record.gen_id is not None:
+                self._pending.append(record)
+
+    def drain_pending(self) -> list[RequestRecord]:
+        """Take the finished requests that have not been flushed yet."""
+        with self._lock:
+            records = list(self._pending)
+            self._pending.clear()
+        return records
+
+    def requeue(self, records: list[RequestRecord]) -> None:
+        """Put records back for the next flush (e.g. their row was not written yet)."""
+        with self._lock:
+            self._pending.extend(records)
+
+    def snapshot(self) -> dict[str, dict[str, Any]]:
+        """Current totals per model, for logging or tests."""
+        with self._lock:
+            return {
+                key: {
+                    "requests": series.requests,
+                    "errors": series.errors,
+                    "prompt_tokens": series.prompt_tokens,
+                    "completion_tokens": series.completion_tokens,
+                    "ttft_avg": series.ttft.sum / series.ttft.count if series.ttft.count else None,
+                    "duration_avg": series.duration.sum / series.duration.count if series.duration.count else None,
+                }
+                for key, series in self._series.items()
+            }
+
+    def render_prometheus(self) -> str:
+        """Render all series in the Prometheus text exposition format (version 0.0.4)."""
+        histograms = (
+            ("llm_time_to_first_token_seconds", "Time from request to first streamed token.", "ttft"),
+            ("llm_inter_token_latency_seconds", "Gap between consecutive streamed chunks.", "inter_token"),
+            ("llm_request_duration_seconds", "Total request duration.", "duration"),
+            ("llm_tokens_per_second", "Completion tokens per second of generation.", "tokens_per_second"),
+        )
+        counters = (
+            ("llm_requests_total", "Finished requests.", "requests"),
+            ("llm_request_errors_total", "Failed requests.", "errors"),
+            ("llm_prompt_tokens_total", "Prompt tokens reported by the API.", "prompt_tokens"),
+            ("llm_completion_tokens_total", "Completion tokens reported by the API.", "completion_tokens"),
+        )
+        with self._lock:
+            items = sorted(self._series.items())
+            lines = []
+            for name, help_text, attr in histograms:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for model, series in items:
+                    histogram: Histogram = getattr(series, attr)
+                    labels = _labels(model)
+                    for le, count in histogram.cumulative():
+                        lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+                    lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+                    lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+            for name, help_text, attr in counters:
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                for model, series in items:
+                    lines.append(f"{name}{{{_labels(model)}}} {getattr(series, attr)}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(model: str) -> str:
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'model="{escape(model)}"'
+
+
+def write_timings(db_handle: Any, records: list[RequestRecord], table: str = "llm_messages") -> list[RequestRecord]:
+    """
+    Store timings on the rows of ``table`` whose gen_id matches, in one transaction.
+
+    The table needs the ttft_ms, duration_ms and tokens_per_second columns
+    (``DBHandler.migrate_table`` adds them from config/db_schema/llm_messages.json).
+
+    Returns:
+        list[RequestRecord]: Records whose row does not exist (yet).
+    """
+    missing = []
+    with db_handle.transaction():
+        for record in records:
+            updated = db_handle.execute(
+                f"UPDATE {table} SET ttft_ms = ?, duration_ms = ?, tokens_per_second = ? WHERE gen_id = ?",
+                (
+                    record.ttft * 1000 if record.ttft is not None else None,
+                    record.duration * 1000,
+                    record.tokens_per_second,
+                    record.gen_id,
+                ),
+            )
+            if not updated:
+                missing.append(record)
+    return missing
+
+
+async def periodic_flush(
+    recorder: MetricsRecorder,
+    db_handle: Any,
+    interval: float = 30.0,
+    table: str = "llm_messages",
+    max_attempts: int = 3,
+) -> None:
+    """
+    Flush finished request timings to ``table`` every ``interval`` seconds until cancelled.
+
+    The message row is usually written after the stream ends, so records whose row is missing are
+    retried on the next flushes, up to ``max_attempts`` times. Run it as a background task.
+    """
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await _flush_once(recorder, db_handle, table, max_attempts)
+    finally:
+        # Final flush on shutdown/cancel
+        await _flush_once(recorder, db_handle, table, max_attempts)
+
+
+async def _flush_once(recorder: MetricsRecorder, db_handle: Any, table: str, max_attempts: int) -> None:
+    records = recorder.drain_pending()
+    if not records:
+        return
+    try:
+        missing = await asyncio.to_thread(write_timings, db_handle, records, table)
+    except Exception as e:
+        logger.error(f"Failed to flush request metrics: {e}")
+        missing = records
+    retry = []
+    for record in missing:
+        record.flush_attempts += 1
+        if record.flush_attempts < max_attempts:
+            retry.append(record)
+    recorder.requeue(retry)
@@ -0,0 +1,237 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+# Lower value = served first
+INTERACTIVE = 0
+BATCH = 10
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    """Budget for one (model, api_key) pair. None means unlimited."""
+
+    requests_per_minute: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at ``per_minute / 60`` per second."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until ``amount`` can be taken (0 if it can be taken now)."""
+        self._refill(now)
+        # A request larger than the whole bucket is let through once the bucket is full
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= amount
+
+    def adjust(self, delta: float) -> None:
+        """Correct an earlier estimate; the level may go negative (debt)."""
+        self.level -= delta
+
+
+@dataclass
+class _KeyState:
+    requests: Optional[TokenBucket]
+    tokens: Optional[TokenBucket]
+    blocked_until: float = 0.0
+    waiters: list = field(default_factory=list)
+    condition: asyncio.Condition = field(default_factory=asyncio.Condition)
+
+    def wait_time(self, tokens: float, now: float) -> float:
+        wait = max(0.0, self.blocked_until - now)
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now))
+        if self.tokens is not None and tokens:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+
+class RateLimitScheduler:
+    """
+    Client-side scheduler that keeps requests inside provider rate limits.
+
+    Each (model, api_key) pair gets a requests/min and a tokens/min bucket. Callers ``acquire`` a
+    slot before sending and are released in priority order (``INTERACTIVE`` before ``BATCH``, then
+    FIFO), so batch scoring jobs queue behind live chat instead of competing with it. Rate-limit
+    headers and ``Retry-After`` from responses pause the key for everyone, which avoids retry storms.
+    """
+
+    def __init__(
+        self,
+        default_limit: Optional[RateLimit] = None,
+        limits: Optional[Mapping[str, RateLimit]] = None,
+    ) -> None:
+        """
+        Args:
+            default_limit (Optional[RateLimit]): Budget for models without an explicit entry.
+            limits (Optional[Mapping[str, RateLimit]]): Per-model budgets.
+        """
+        self.default_limit = default_limit or RateLimit()
+        self.limits = dict(limits or {})
+        self._states: dict[tuple[str, str], _KeyState] = {}
+        self._sequence = itertools.count()
+
+    def _state(self, model: str, api_key: str) -> _KeyState:
+        key = (model, api_key)
+        state = self._states.get(key)
+        if state is None:
+            limit = self.limits.get(model, self.default_limit)
+            state = _KeyState(
+                requests=TokenBucket(limit.requests_per_minute) if limit.requests_per_minute else None,
+                tokens=TokenBucket(limit.tokens_per_minute) if limit.tokens_per_minute else None,
+            )
+            self._states[key] = state
+        return state
+
+    async def acquire(self, model: str, api_key: str, tokens: int = 0, priority: int = INTERACTIVE) -> None:
+        """
+        Wait until a request of ``tokens`` estimated tokens may be sent, then reserve it.
+
+        Args:
+            model (str): Model the request goes to.
+            api_key (str): API key the request is billed to.
+            tokens (int): Estimated prompt + completion tokens.
+            priority (int): Lower is served first.
+        """
+        state = self._state(model, api_key)
+        ticket = (priority, next(self._sequence))
+        async with state.condition:
+            heapq.heappush(state.waiters, ticket)
+            try:
+                while True:
+                    timeout = None
+                    if state.waiters[0] == ticket:
+                        timeout = state.wait_time(tokens, time.monotonic())
+                        if timeout <= 0:
+                            break
+                    try:
+                        await asyncio.wait_for(state.condition.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                if state.requests is not None:
+                    state.requests.take(1)
+                if state.tokens is not None:
+                    state.tokens.take(tokens)
+            finally:
+                state.waiters.remove(ticket)
+                heapq.heapify(state.waiters)
+                state.condition.notify_all()
+
+    def record_usage(self, model: str, api_key: str, estimated: int, actual: Optional[int]) -> None:
+        """Replace the estimate taken in ``acquire`` with the real token usage."""
+        state = self._state(model, api_key)
+        if state.tokens is not None and actual is not None:
+            state.tokens.adjust(actual - estimated)
+
+    def block(self, model: str, api_key: str, seconds: float) -> None:
+        """Pause all requests for this key for ``seconds`` (e.g. after a 429)."""
+        if seconds <= 0:
+            return
+        state = self._state(model, api_key)
+        state.blocked_until = max(state.blocked_until, time.monotonic() + seconds)
+        logger.warning(f"Rate limited on {model}; pausing requests for {seconds:.2f} seconds")
+
+    def update_from_headers(self, model: str, api_key: str, headers: Mapping[str, str]) -> Optional[float]:
+        """
+        Read Retry-After / rate-limit headers and pause the key if the provider asks for it.
+
+        Returns:
+            Optional[float]: The pause in seconds, if one was applied.
+        """
+        delay = parse_retry_after(headers)
+        if delay is None:
+            delay = _exhausted_reset(headers)
+        if delay is not None:
+            self.block(model, api_key, delay)
+        return delay
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Parse ``Retry-After`` given either in seconds or as an HTTP date."""
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parse "1s", "6m0s", "250ms" style durations used by OpenAI-compatible providers."""
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(number) * scale[unit] for number, unit in parts)
+
+
+def _exhausted_reset(headers: Mapping[str, str]) -> Optional[float]:
+    """If a remaining-quota header reached zero, return seconds until its reset."""
+    for remaining_name, reset_name in (
+        ("x-ratelimit-remaining-requests", "x-ratelimit-reset-requests"),
+        ("x-ratelimit-remaining-tokens", "x-ratelimit-reset-tokens"),
+        ("x-ratelimit-remaining", "x-ratelimit-reset"),
+    ):
+        remaining = headers.get(remaining_name)
+        reset = headers.get(reset_name)
+        if remaining is None or reset is None:
+            continue
+        try:
+            if float(remaining) > 0:
+                continue
+        except ValueError:
+            continue
+        try:
+            reset_value = float(reset)
+        except ValueError:
+            return _parse_duration(reset)
+        # OpenRouter sends an epoch timestamp in milliseconds
+        if reset_value > 1e12:
+            return max(0.0, reset_value / 1000 - time.time())
+        if reset_value > 1e9:
+            return max(0.0, reset_value - time.time())
+        return reset_value
+    return None
+
+
+def jittered_backoff(attempt: int, backoff_factor: float, cap: float = 30.0) -> float:
+    """Full-jitter exponential backoff, so concurrent clients do not retry in lockstep."""
+    return random.uniform(0, min(cap, backoff_factor * (2 ** attempt)))
+
+
+def estimate_request_tokens(messages: list[dict[str, str]], max_tokens: Optional[int] = None) -> int:
+    """Cheap estimate of the tokens a request will consume, for budgeting before it is sent."""
+    prompt = sum(len(message.get("content") or "") for message in messages) // 2 + 4 * len(messages)
+    return prompt + (max_tokens or 0)
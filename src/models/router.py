@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncGenerator, Awaitable, Callable, Optional, Sequence
+
+from .llm_clinet3 import LLMClient
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
+@dataclass(frozen=True)
+class ModelEndpoint:
+    """One model/endpoint the router may send a request to."""
+
+    model: str
+    url: str = DEFAULT_URL
+    api_key: Optional[str] = None
+
+
+@dataclass
+class EndpointStats:
+    """Rolling latency (time to first token for streams) and error rate of one endpoint."""
+
+    window: int = 50
+    latencies: deque = field(default_factory=deque)
+    outcomes: deque = field(default_factory=deque)
+
+    def record(self, ok: bool, latency: Optional[float] = None) -> None:
+        self.outcomes.append(ok)
+        if len(self.outcomes) > self.window:
+            self.outcomes.popleft()
+        if latency is not None:
+            self.latencies.append(latency)
+            if len(self.latencies) > self.window:
+                self.latencies.popleft()
+
+    @property
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ModelRouter:
+    """
+    Routes chat completions over an ordered list of models/endpoints.
+
+    Endpoints are tried in the given order, with unhealthy ones (error rate above
+    ``max_error_rate`` over the rolling window) moved to the back; with ``strategy="fastest"``
+    healthy endpoints are ordered by median latency instead. A failure before the first token
+    falls through to the next endpoint.
+
+    With ``hedge_after_ms`` set, if the current endpoint has not produced its first token (or
+    its answer, when not streaming) within that time, the next endpoint is started as well and
+    whichever answers first wins; the loser is cancelled.
+    """
+
+    def __init__(
+        self,
+        endpoints: Sequence[ModelEndpoint | str],
+        hedge_after_ms: Optional[float] = None,
+        strategy: str = "ordered",
+        max_error_rate: float = 0.5,
+        window: int = 50,
+        api_key: Optional[str] = None,
+        **client_kwargs: Any,
+    ) -> None:
+        """
+        Args:
+            endpoints (Sequence[ModelEndpoint | str]): Endpoints in order of preference. Strings are model names on the default URL.
+            hedge_after_ms (Optional[float]): Start the next endpoint if no first token arrived after this many ms.
+            strategy (str): "ordered" to keep the given order, "fastest" to prefer the lowest median latency.
+            max_error_rate (float): Endpoints failing more often than this are tried last.
+            window (int): Number of recent requests the statistics cover.
+            api_key (Optional[str]): Key for endpoints that do not set their own. Defaults to OPENROUTER_API_KEY.
+            **client_kwargs: Passed to every LLMClient (pool, rate_limiter, cache, json_backend, ...).
+
+        Raises:
+            ValueError: If no endpoints are given or the strategy is unknown.
+        """
+        if not endpoints:
+            raise ValueError("At least one endpoint is required.")
+        if strategy not in ("ordered", "fastest"):
+            raise ValueError(f"Unknown routing strategy: {strategy}")
+        self.endpoints = [ModelEndpoint(ep) if isinstance(ep, str) else ep for ep in endpoints]
+        self.hedge_after = hedge_after_ms / 1000 if hedge_after_ms is not None else None
+        self.strategy = strategy
+        self.max_error_rate = max_error_rate
+        self.stats = {ep: EndpointStats(window=window) for ep in self.endpoints}
+        self.clients = {
+            ep: LLMClient(model=ep.model, url=ep.url, api_key=ep.api_key or api_key, **client_kwargs)
+            for ep in self.endpoints
+        }
+
+    async def __aenter__(self):
+        for client in self.clients.values():
+            await client.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        for client in self.clients.values():
+            await client.__aexit__(None, None, None)
+        if exc_type:
+            logger.error(f"An error occurred: {exc_type.__name__}: {exc_value}")
+
+    def ranked(self) -> list[ModelEndpoint]:
+        """Endpoints in the order they will be tried for the next request."""
+        def key(item: tuple[int, ModelEndpoint]):
+            index, ep = item
+            stats = self.stats[ep]
+            unhealthy = stats.error_rate > self.max_error_rate
+            if self.strategy == "fastest":
+                median = stats.percentile(0.5)
+                return (unhealthy, median if median is not None else 0.0, index)
+            return (unhealthy, index)
+        return [ep for _, ep in sorted(enumerate(self.endpoints), key=key)]
+
+    async def post_chat_completion(
+        self,
+        messages: list[dict[str, str]],
+        stream: bool = False,
+        include_meta_data: bool = False,
+        **kwargs: Any,
+    ) -> dict[str, Any] | AsyncGenerator[str | dict[str, Any], None]:
+        """
+        Same interface as LLMClient.post_chat_completion, routed over the configured endpoints.
+
+        Raises:
+            httpx.HTTPError: The last error, if every endpoint failed.
+        """
+        if stream:
+            return self._stream_routed(messages, include_meta_data, kwargs)
+
+        async def complete(ep: ModelEndpoint):
+            return await self.clients[ep].post_chat_completion(
+                messages, stream=False, include_meta_data=include_meta_data, **kwargs
+            )
+
+        _, result = await self._race(complete)
+        return result
+
+    async def _stream_routed(
+        self,
+        messages: list[dict[str, str]],
+        include_meta_data: bool,
+        kwargs: dict[str, Any],
+    ) -> AsyncGenerator[str | dict[str, Any], None]:
+        async def first_chunk(ep: ModelEndpoint):
+            chunks = await self.clients[ep].post_chat_completion(
+                messages, stream=True, include_meta_data=include_meta_data, **kwargs
+            )
+            try:
+                first = await chunks.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await chunks.aclose()
+                raise
+            return chunks, first
+
+        ep, (chunks, first) = await self._race(first_chunk, cleanup=lambda result: result[0].aclose())
+        try:
+            if first is not None:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+        except Exception:
+            self.stats[ep].record(False)
+            raise
+        finally:
+            await chunks.aclose()
+
+    async def _race(
+        self,
+        start: Callable[[ModelEndpoint], Awaitable[Any]],
+        cleanup: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ) -> tuple[ModelEndpoint, Any]:
+        """
+        Run ``start`` on endpoints in rank order until one succeeds, hedging if configured.
+
+        Returns the winning endpoint and its result; results of hedged losers that finished anyway
+        are passed to ``cleanup``.
+        """
+        candidates = self.ranked()
+        running: dict[asyncio.Task, tuple[ModelEndpoint, float]] = {}
+        errors: list[BaseException] = []
+        next_index = 0
+
+        def launch() -> None:
+            nonlocal next_index
+            ep = candidates[next_index]
+            next_index += 1
+            running[asyncio.create_task(start(ep))] = (ep, time.monotonic())
+
+        launch()
+        winner = None
+        try:
+            while running and winner is None:
+                can_hedge = self.hedge_after is not None and next_index < len(candidates)
+                done, _ = await asyncio.wait(
+                    running, timeout=self.hedge_after if can_hedge else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    logger.info(f"No response within {self.hedge_after * 1000:.0f} ms; hedging to {candidates[next_index].model}")
+                    launch()
+                    continue
+                for task in done:
+                    ep, started = running.pop(task)
+                    error = task.exception()
+                    if error is not None:
+                        self.stats[ep].record(False)
+                        logger.warning(f"{ep.model} failed: {error}")
+                        errors.append(error)
+                    elif winner is None:
+                        self.stats[ep].record(True, time.monotonic() - started)
+                        winner = (ep, task.result())
+                    elif cleanup is not None:
+                        await cleanup(task.result())
+                if winner is None and not running and next_index < len(candidates):
+                    launch()
+        finally:
+            for task in running:
+                task.cancel()
+            results = await asyncio.gather(*running, return_exceptions=True)
+            if cleanup is not None:
+                for result in results:
+                    if not isinstance(result, BaseException):
+                        await cleanup(result)
+        if winner is None:
+            raise errors[-1]
+        return winner
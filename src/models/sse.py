@@ -0,0 +1,139 @@
+import re
+from dataclasses import dataclass
+from typing import AsyncIterable, AsyncIterator, Optional
+
+# Lines may end with CRLF, LF or a lone CR (https://html.spec.whatwg.org/multipage/server-sent-events.html)
+_LINE_END = re.compile(rb"\r\n|\r|\n")
+
+
+@dataclass
+class SSEEvent:
+    """A single dispatched server-sent event."""
+
+    data: str
+    event: str = "message"
+    id: Optional[str] = None
+    retry: Optional[int] = None
+
+
+class SSEDecoder:
+    """
+    Incremental decoder for a ``text/event-stream`` body.
+
+    Feed it raw byte chunks in arrival order and it returns the events completed by each chunk.
+    Bytes are buffered in a ``bytearray`` and split on line endings before decoding; line
+    terminators are ASCII, so every complete line is complete UTF-8 even when a multibyte
+    character straddles two network chunks. Consumed bytes are dropped once per ``feed`` call,
+    which keeps the cost linear in the size of the stream.
+
+    Comment lines (starting with ``:``, e.g. OpenRouter's ``: OPENROUTER PROCESSING``) are skipped,
+    and multi-line ``data:`` fields are joined with ``\\n`` as the spec requires.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._data_lines: list[str] = []
+        self._event: Optional[str] = None
+        self._last_event_id: Optional[str] = None
+        self._retry: Optional[int] = None
+
+    def feed(self, chunk: bytes) -> list[SSEEvent]:
+        """
+        Add a chunk of bytes and return the events it completed.
+
+        Args:
+            chunk (bytes): The next chunk of the response body.
+
+        Returns:
+            list[SSEEvent]: Events whose terminating blank line was contained in the buffered data.
+        """
+        self._buffer += chunk
+        events: list[SSEEvent] = []
+        pos = 0
+        buffer_len = len(self._buffer)
+        while True:
+            match = _LINE_END.search(self._buffer, pos)
+            if match is None:
+                break
+            # A CR at the very end may be the first half of a CRLF split across chunks
+            if match.group() == b"\r" and match.end() == buffer_len:
+                break
+            line = self._buffer[pos:match.start()].decode("utf-8", errors="replace")
+            pos = match.end()
+            event = self._process_line(line)
+            if event is not None:
+                events.append(event)
+        if pos:
+            del self._buffer[:pos]
+        return events
+
+    def flush(self) -> list[SSEEvent]:
+        """
+        Finish the stream, treating any unterminated trailing line as complete.
+
+        Returns:
+            list[SSEEvent]: The last pending event, if the stream ended without a blank line.
+        """
+        events: list[SSEEvent] = []
+        if self._buffer:
+            line = self._buffer.rstrip(b"\r").decode("utf-8", errors="replace")
+            self._buffer.clear()
+            self._process_line(line)
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _process_line(self, line: str) -> Optional[SSEEvent]:
+        if not line:
+            return self._dispatch()
+        if line.startswith(":"):
+            return None
+
+        field, sep, value = line.partition(":")
+        if sep and value.startswith(" "):
+            value = value[1:]
+
+        if field == "data":
+            self._data_lines.append(value)
+        elif field == "event":
+            self._event = value
+        elif field == "id":
+            if "\0" not in value:
+                self._last_event_id = value
+        elif field == "retry":
+            if value.isdigit():
+                self._retry = int(value)
+        return None
+
+    def _dispatch(self) -> Optional[SSEEvent]:
+        if not self._data_lines:
+            self._event = None
+            return None
+        event = SSEEvent(
+            data="\n".join(self._data_lines),
+            event=self._event or "message",
+            id=self._last_event_id,
+            retry=self._retry,
+        )
+        self._data_lines = []
+        self._event = None
+        return event
+
+
+async def aiter_sse(byte_stream: AsyncIterable[bytes]) -> AsyncIterator[SSEEvent]:
+    """
+    Decode an async byte stream (e.g. ``httpx.Response.aiter_bytes()``) into server-sent events.
+
+    Args:
+        byte_stream (AsyncIterable[bytes]): The raw response body chunks.
+
+    Yields:
+        SSEEvent: Each event as soon as its terminating blank line arrives.
+    """
+    decoder = SSEDecoder()
+    async for chunk in byte_stream:
+        for event in decoder.feed(chunk):
+            yield event
+    for event in decoder.flush():
+        yield event
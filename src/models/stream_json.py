@@ -0,0 +1,135 @@
+import json
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgspec
+except ImportError:  # optional: pip install chat-management[fast-json]
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:  # optional: pip install chat-management[fast-json]
+    orjson = None
+
+
+BACKENDS = ("msgspec", "orjson", "json")
+
+
+@dataclass(slots=True)
+class StreamDelta:
+    """The useful part of one streamed chat completion chunk."""
+
+    content: str = ""
+    meta: Optional[dict[str, Any]] = None
+
+
+def extract_meta_data(data: dict[str, Any]) -> dict[str, Any]:
+    usage = data.get("usage") or {}
+    return {
+        "id": data.get("id"),
+        "model": data.get("model"),
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "created": data.get("created"),
+        "object": data.get("object"),
+        "system_fingerprint": data.get("system_fingerprint"),
+    }
+
+
+if msgspec is not None:
+
+    class _Delta(msgspec.Struct):
+        content: Optional[str] = None
+
+    class _Choice(msgspec.Struct):
+        delta: Optional[_Delta] = None
+
+    class _Chunk(msgspec.Struct):
+        # Unknown fields are skipped without being materialised. Metadata is passed through as-is,
+        # so providers that send e.g. a float "created" are not rejected.
+        id: Any = None
+        model: Any = None
+        created: Any = None
+        object: Any = None
+        system_fingerprint: Any = None
+        choices: Optional[list[_Choice]] = None
+        usage: Optional[dict[str, Any]] = None
+
+
+class ChunkDecoder:
+    """
+    Decodes the JSON payload of an OpenAI-compatible streaming chunk into a ``StreamDelta``.
+
+    With msgspec the payload is decoded straight into typed structs, so only the fields we read
+    are built; valid JSON that does not fit the structs is decoded again as a dict, so every backend
+    returns the same result. orjson and the stdlib ``json`` module are used as dict-based fallbacks.
+    """
+
+    def __init__(self, backend: Optional[str] = None) -> None:
+        """
+        Args:
+            backend (Optional[str]): "msgspec", "orjson" or "json". Defaults to the fastest one installed.
+
+        Raises:
+            ValueError: If the requested backend is unknown or not installed.
+        """
+        self.backend = backend or available_backends()[0]
+        if self.backend not in available_backends():
+            raise ValueError(f"JSON backend '{self.backend}' is not available. Installed: {available_backends()}")
+
+        self._loads: Callable[[Any], Any] = orjson.loads if orjson is not None and self.backend != "json" else json.loads
+        if self.backend == "msgspec":
+            self._decoder = msgspec.json.Decoder(_Chunk, strict=False)
+            self.decode = self._decode_msgspec
+        else:
+            self.decode = self._decode_dict
+
+    def _decode_msgspec(self, payload: str | bytes) -> StreamDelta:
+        try:
+            chunk = self._decoder.decode(payload)
+        except msgspec.ValidationError:
+            # Valid JSON with an unexpected shape: read it the same way the other backends do
+            return self._decode_dict(payload)
+        except msgspec.DecodeError as e:
+            raise ValueError(str(e)) from e
+        content = ""
+        if chunk.choices:
+            delta = chunk.choices[0].delta
+            if delta is not None and delta.content:
+                content = delta.content
+        meta = None
+        # Same rule as the dict path: an empty or null usage block is not metadata
+        if chunk.usage:
+            meta = {
+                "id": chunk.id,
+                "model": chunk.model,
+                "prompt_tokens": chunk.usage.get("prompt_tokens"),
+                "completion_tokens": chunk.usage.get("completion_tokens"),
+                "created": chunk.created,
+                "object": chunk.object,
+                "system_fingerprint": chunk.system_fingerprint,
+            }
+        return StreamDelta(content, meta)
+
+    def _decode_dict(self, payload: str | bytes) -> StreamDelta:
+        data = self._loads(payload)
+        if not isinstance(data, dict):
+            raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+        content = ""
+        choices = data.get("choices")
+        if choices:
+            delta = choices[0].get("delta")
+            if delta:
+                content = delta.get("content") or ""
+        meta = extract_meta_data(data) if data.get("usage") else None
+        return StreamDelta(content, meta)
+
+
+def available_backends() -> list[str]:
+    """Installed backends, fastest first."""
+    installed = {"msgspec": msgspec is not None, "orjson": orjson is not None, "json": True}
+    return [name for name in BACKENDS if installed[name]]